@@ -49,6 +49,7 @@ namespace WebArena {
 		public List<Dictionary<string, string>> Entities { get; set; }
 		public Dictionary<int, BspMaterialLayer[]> Materials { get; set; }
 		public BspMesh[] Meshes { get; set; }
+		public int[][] LightmapSizes { get; set; }
 		public Dictionary<int, byte[]> Lightmaps { get; set; }
 		public BspPlane[] Planes { get; set; }
 		public BspBrush[] Brushes { get; set; }
@@ -106,8 +107,10 @@ namespace WebArena {
 						wmat.SetBlend(mat.Blend[0], mat.Blend[1]);
 				}
 			}
-			foreach(var pair in data.Lightmaps)
-				lightmaps[pair.Key] = new Texture(pair.Value, 128, 128, 3);
+			foreach(var pair in data.Lightmaps) {
+				var lmsize = data.LightmapSizes != null ? data.LightmapSizes[pair.Key] : new[] { 128, 128 };
+				lightmaps[pair.Key] = new Texture(pair.Value, lmsize[0], lmsize[1], 3);
+			}
 			foreach(var mesh in data.Meshes) {
 				var wmesh = new Mesh(mesh.Indices, materials[mesh.MaterialIndex], mesh.LightmapIndex != -1 ? lightmaps[mesh.LightmapIndex] : Texture.White);
 				wmesh.Add(new MeshBuffer(VertexFormat.All, mesh.Vertices));
@@ -49,11 +49,21 @@ namespace WebArena {
 		public Texture(byte[] pixels, int width, int height, int components) {
 			GTexture = gl.CreateTexture();
 			gl.BindTexture(gl.TEXTURE_2D, GTexture);
+			// Rows of RGB pixels need not fill whole 4 byte words.
+			gl.PixelStorei(gl.UNPACK_ALIGNMENT, 1);
 			gl.TexImage2D(gl.TEXTURE_2D, 0, components == 4 ? gl.RGBA : gl.RGB, width, height, 0, components == 4 ? gl.RGBA : gl.RGB, gl.UNSIGNED_BYTE, new Uint8Array(pixels));
-			gl.TexParameteri(gl.TEXTURE_2D, gl.TEXTURE_WRAP_S, gl.REPEAT);
-			gl.TexParameteri(gl.TEXTURE_2D, gl.TEXTURE_WRAP_T, gl.REPEAT);
-			gl.TexParameteri(gl.TEXTURE_2D, gl.TEXTURE_MIN_FILTER, gl.NEAREST_MIPMAP_LINEAR);
-			gl.GenerateMipmap(gl.TEXTURE_2D);
+			gl.PixelStorei(gl.UNPACK_ALIGNMENT, 4);
+			// WebGL only repeats and mipmaps power of two textures, e.g. not atlas pages.
+			if(IsPOT(width) && IsPOT(height)) {
+				gl.TexParameteri(gl.TEXTURE_2D, gl.TEXTURE_WRAP_S, gl.REPEAT);
+				gl.TexParameteri(gl.TEXTURE_2D, gl.TEXTURE_WRAP_T, gl.REPEAT);
+				gl.TexParameteri(gl.TEXTURE_2D, gl.TEXTURE_MIN_FILTER, gl.NEAREST_MIPMAP_LINEAR);
+				gl.GenerateMipmap(gl.TEXTURE_2D);
+			} else {
+				gl.TexParameteri(gl.TEXTURE_2D, gl.TEXTURE_WRAP_S, gl.CLAMP_TO_EDGE);
+				gl.TexParameteri(gl.TEXTURE_2D, gl.TEXTURE_WRAP_T, gl.CLAMP_TO_EDGE);
+				gl.TexParameteri(gl.TEXTURE_2D, gl.TEXTURE_MIN_FILTER, gl.LINEAR);
+			}
 		}
 
 		public void Use() {
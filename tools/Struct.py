@@ -1,12 +1,40 @@
-import copy, struct, sys
+import array, copy, mmap, struct, sys, weakref
+from collections import OrderedDict
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
 
 class AttrDict(dict):
 	def __init__(self, *args, **kwargs):
 		super(AttrDict, self).__init__(*args, **kwargs)
 		self.__dict__ = self
 
+ABSOLUTE = 0
+STRUCT_RELATIVE = 1
+RELATIVE = 2
+
 class Ignorable:
 	_ignore = False
+	_array = False
+	_at = None
+
+	# Marks a primitive array to be decoded into an array.array in one copy,
+	# rather than into a list of Python numbers.
+	@property
+	def array(self):
+		out = copy.copy(self)
+		out._array = True
+		return out
+
+	# Places an array out of line, `offset` bytes from the struct start (or as
+	# given by `whence`), instead of at the current position.
+	def at(self, offset, whence=STRUCT_RELATIVE):
+		out = copy.copy(self)
+		out._at = offset, whence
+		return out
+
 	@property
 	def ignore(self):
 		out = copy.deepcopy(self)
@@ -30,22 +58,23 @@ class NameSurrogate(object):
 
 nameSurrogate = NameSurrogate()
 
-ABSOLUTE = 0
-STRUCT_RELATIVE = 1
-RELATIVE = 2
 class struct_seek(object):
 	def __init__(self, offset, whence=ABSOLUTE):
 		self.offset, self.whence = offset, whence
+		self.scoped = False
+		self.lastpos = []
 		frame = BaseStruct.__framestack__[-1]
 		names = [name for name in frame.f_code.co_varnames[frame.f_code.co_argcount:] if name in frame.f_locals]
 		s = BaseStruct.__structstack__[-1]
 		s.trigger_after(names[-1] if len(names) else None, self.seek)
 
 	def __enter__(self):
-		pass
+		self.scoped = True
 
 	def seek(self, s):
-		self.lastpos = s.tell()
+		lastpos = s.tell()
+		if self.scoped:
+			self.lastpos.append(lastpos)
 
 		if isinstance(self.offset, str) or isinstance(self.offset, unicode):
 			offset = getattr(s, self.offset)
@@ -57,10 +86,10 @@ class struct_seek(object):
 		elif self.whence == STRUCT_RELATIVE:
 			s.seek(s.__startpos__ + offset)
 		elif self.whence == RELATIVE:
-			s.seek(self.lastpos + offset)
+			s.seek(lastpos + offset)
 
 	def unseek(self, s):
-		s.seek(self.lastpos)
+		s.seek(self.lastpos.pop())
 
 	def __exit__(self, type, value, tb):
 		frame = BaseStruct.__framestack__[-1]
@@ -68,9 +97,14 @@ class struct_seek(object):
 		s = BaseStruct.__structstack__[-1]
 		s.trigger_after(names[-1] if len(names) else None, self.unseek)
 
+# Declares the size of the struct, as a field name or a constant, for structs
+# whose data extends past their inline fields (e.g. into .at() arrays).
+def struct_size(size):
+	BaseStruct.__structstack__[-1].extent = size
+
 class StructType(IgnorableTuple):
 	def __getitem__(self, value):
-		if isinstance(value, tuple):
+		if isinstance(value, tuple) or callable(value):
 			return IgnorableTuple(('array', (self, value)))
 		else:
 			return IgnorableList([self] * value)
@@ -102,202 +136,489 @@ def string(len, offset=0, encoding=None, nullTerm=True, stripNulls=True, value='
 	return StructType(('string', (len, offset, encoding, nullTerm, stripNulls, value)))
 
 class ArrayType(object):
+	array = False
+	offset = None
+	whence = STRUCT_RELATIVE
+
 	def __init__(self, type, obj, attr):
 		self.type = type
 		self.obj = obj
 		self.attr = attr
 
-	def count(self):
-		return getattr(self.obj, self.attr)
+	def count(self, s):
+		return getattr(s if self.obj is None else self.obj, self.attr)
 
 class ExprArrayType(ArrayType):
-	def __init__(self, type, obj, cb):
+	def __init__(self, type, cb):
 		self.type = type
-		self.obj = obj
 		self.cb = cb
 
-	def count(self):
-		return self.cb(self.obj)
+	def count(self, s):
+		return self.cb(s)
 
 class ConstantArrayType(ArrayType):
 	def __init__(self, type, size):
 		self.type = type
 		self.size = size
 
-	def count(self):
+	def count(self, s):
 		return self.size
 
 class StructException(Exception):
 	pass
 
+PRIMITIVE, STRING, STRUCT, ARRAY = range(4)
+
+# Decode through per-layout generated code (see structcodec.py) rather than
+# interpreting the ops for every record.
+useCodecs = True
+
+dtypecodes = dict(b='i1', B='u1', h='i2', H='u2', i='i4', I='u4', l='i4', L='u4', q='i8', Q='u8', f='f4', d='f8')
+dtypeendian = {'<' : '<', '>' : '>', '!' : '>', '=' : '='}
+
+# Compiled form of a @Struct format function.  The format function is traced
+# once per class; every instance then shares the resulting op list, so
+# constructing or unpacking a record only has to fill in values.
+class Layout(object):
+	def __init__(self, cls):
+		self.cls = cls
+		self.endian = cls.__endian__
+		self.names = []
+		self.ignored = set()
+		self.defaults = {}
+		self.factories = []
+		self.triggers = {}
+		self.fields = []
+		self.numpyDtype = None
+		self.decode = None
+		self.extent = None
+
+		func = cls.__format_func__
+		if func is not None:
+			self.trace(func.im_func)
+		self.compile()
+
+		# Instances are created as this subclass, which stores each declared
+		# field in its own slot.
+		self.record = type(cls.__name__, (cls, ), dict(__slots__=tuple(self.names), __layout__=self, __module__=cls.__module__))
+
+	def trace(self, func):
+		frames = []
+		def tracer(frame, event, arg):
+			if not frames:
+				frames.append(frame)
+				BaseStruct.__framestack__.append(frame)
+
+		BaseStruct.__structstack__.append(self)
+		prev = sys.gettrace()
+		sys.settrace(tracer)
+		try:
+			if func.func_code.co_argcount == 1:
+				func(nameSurrogate)
+			else:
+				func()
+		finally:
+			sys.settrace(prev)
+			BaseStruct.__structstack__.pop()
+			if frames:
+				BaseStruct.__framestack__.pop()
+
+		f_locals = frames[0].f_locals
+		for name in func.func_code.co_varnames[func.func_code.co_argcount:]:
+			if name in f_locals:
+				self.add(name, f_locals[name])
+
+	def trigger_after(self, name, cb):
+		if name not in self.triggers:
+			self.triggers[name] = []
+		self.triggers[name].append(cb)
+
+	def add(self, name, value):
+		self.names.append(name)
+		if getattr(value, '_ignore', False) is True:
+			self.ignored.add(name)
+
+		asArray = getattr(value, '_array', False) is True
+		at = getattr(value, '_at', None)
+		islist = isinstance(value, list)
+		if islist and (asArray or at is not None):
+			value, islist = ('array', (value[0], len(value))), False
+		elif at is not None and tuple(value)[0] != 'array':
+			raise StructException('Only arrays can be placed with at(): %s' % name)
+		if not islist:
+			value = [value]
+
+		defaults = []
+		for sub in value:
+			if isinstance(sub, BaseStruct):
+				sub = sub.__getlayout__().cls
+			try:
+				if issubclass(sub, BaseStruct):
+					sub = ('struct', sub)
+			except TypeError:
+				pass
+			type_, size = tuple(sub)
+			if type_ == 'string':
+				self.fields.append((STRING, size[:5], name, islist))
+				defaults.append(size[5])
+			elif type_ == 'struct':
+				self.fields.append((STRUCT, size, name, islist))
+				defaults.append(size)
+			elif type_ == 'array':
+				stype, size = size
+				if isinstance(size, tuple):
+					if hasattr(size, '__fieldname__'):
+						obj, attr = None, size.__fieldname__
+					else:
+						obj, attr = size
+					arg = ArrayType(stype, obj, attr)
+				elif isinstance(size, str):
+					arg = ArrayType(stype, None, size)
+				elif callable(size):
+					arg = ExprArrayType(stype, size)
+				else:
+					arg = ConstantArrayType(stype, size)
+				self.fields.append((ARRAY, arg, name, False))
+				if at is not None:
+					arg.offset, arg.whence = at
+
+				if asArray and tuple(stype)[0] not in ('struct', 'string'):
+					arg.array = True
+					arg.typecode = arraycode(tuple(stype)[0])
+					arg.swap = (self.endian in '>!' and sys.byteorder == 'little') or (self.endian == '<' and sys.byteorder == 'big')
+					if isinstance(arg, ConstantArrayType):
+						defaults.append(lambda code=arg.typecode, n=arg.size: array.array(code, [0]) * n)
+					else:
+						defaults.append(lambda code=arg.typecode: array.array(code))
+				else:
+					defaults.append(list)
+			else:
+				self.fields.append((PRIMITIVE, (type_, size), name, islist))
+				defaults.append(0)
+
+		if islist:
+			self.factories.append((name, lambda defaults=defaults: [x() if callable(x) else x for x in defaults]))
+		elif callable(defaults[0]):
+			self.factories.append((name, defaults[0]))
+		else:
+			self.defaults[name] = defaults[0]
+
+	def compile(self):
+		# Merge runs of primitive fields into a single struct.Struct, breaking
+		# the run wherever a trigger has to fire between two fields.
+		self.start_triggers = tuple(self.triggers.get(None, ()))
+		last = {}
+		for i, (kind, arg, name, islist) in enumerate(self.fields):
+			last[name] = i
+
+		ops = []
+		group = None
+		for i, (kind, arg, name, islist) in enumerate(self.fields):
+			if kind == PRIMITIVE:
+				if group is None:
+					group = [[], 0, [], 0]
+				fmt, size = arg
+				group[0].append(fmt)
+				group[1] += size
+				plan, j = group[2], group[3]
+				if islist and plan and plan[-1][0] == name:
+					plan[-1] = (name, plan[-1][1], j + 1)
+				else:
+					plan.append((name, j, j + 1 if islist else None))
+				group[3] += 1
+			else:
+				if group is not None:
+					ops.append(self.group(group))
+					group = None
+				ops.append([kind, arg, name, islist, None, ()])
+
+			if last[name] == i and name in self.triggers:
+				if group is not None:
+					ops.append(self.group(group))
+					group = None
+				ops[-1][5] = tuple(self.triggers[name])
+		if group is not None:
+			ops.append(self.group(group))
+		self.ops = tuple(tuple(op) for op in ops)
+		self.listnames = tuple(set(name for kind, arg, name, islist in self.fields if islist and kind in (STRING, STRUCT)))
+
+		size = 0
+		for kind, arg, name, islist, fsize, triggers in self.ops:
+			if kind == PRIMITIVE:
+				size += fsize
+			elif kind == STRING and not isinstance(arg[0], str):
+				size += arg[0]
+			elif kind == STRUCT and arg.__getlayout__().size is not None:
+				size += arg.__layout__.size
+			elif kind == ARRAY and arg.offset is not None:
+				pass
+			elif kind == ARRAY and isinstance(arg, ConstantArrayType) and itemsize(arg.type) is not None:
+				size += arg.size * itemsize(arg.type)
+			else:
+				size = None
+				break
+		if self.extent is not None:
+			size = self.extent if isinstance(self.extent, (int, long)) else None
+		self.size = size
+
+	def group(self, group):
+		fmt, size, plan, count = group
+		runs = []
+		for code in fmt:
+			if runs and runs[-1][1] == code:
+				runs[-1][0] += 1
+			else:
+				runs.append([1, code])
+		fmt = ''.join(code if n == 1 else '%i%s' % (n, code) for n, code in runs)
+		return [PRIMITIVE, struct.Struct(self.endian + fmt), tuple(plan), False, size, ()]
+
+	def dtype(self):
+		if self.numpyDtype is not None:
+			return self.numpyDtype
+		if np is None:
+			raise StructException('numpy is required for array decoding')
+		if self.size is None:
+			raise StructException('%s is not a fixed-size struct' % self.cls.__name__)
+		if self.endian not in dtypeendian:
+			raise StructException('Unsupported byte order for numpy: %r' % self.endian)
+		if any(kind == ARRAY and arg.offset is not None for kind, arg, name, islist in self.fields):
+			raise StructException('%s has out of line arrays' % self.cls.__name__)
+
+		names, formats, offsets = [], [], []
+		offset = 0
+		for kind, arg, name, islist in self.fields:
+			if kind == PRIMITIVE:
+				format, size = dtypeendian[self.endian] + dtypecodes[arg[0]], arg[1]
+			elif kind == STRING:
+				format, size = 'S%i' % arg[0], arg[0]
+			elif kind == STRUCT:
+				format = arg.__getlayout__().dtype()
+				size = format.itemsize
+			else:
+				stype = tuple(arg.type)
+				format = stype[1].__getlayout__().dtype() if stype[0] == 'struct' else dtypeendian[self.endian] + dtypecodes[stype[0]]
+				format = np.dtype((format, (arg.size, )))
+				size = format.itemsize
+
+			if islist and names and names[-1] == name:
+				format, count = formats[-1]
+				formats[-1] = format, count + 1
+			else:
+				names.append(name)
+				formats.append((format, 1) if islist else format)
+				offsets.append(offset)
+			offset += size
+
+		formats = [np.dtype((format[0], (format[1], ))) if isinstance(format, tuple) else format for format in formats]
+		self.numpyDtype = np.dtype(dict(names=names, formats=formats, offsets=offsets, itemsize=self.size))
+		return self.numpyDtype
+
+	def decoder(self):
+		if self.decode is None:
+			self.decode = BaseStruct.__interpret__.im_func
+			if useCodecs:
+				import structcodec
+				self.decode = structcodec.build(self)
+		return self.decode
+
+	def init(self, s):
+		for name, value in self.defaults.iteritems():
+			setattr(s, name, value)
+		for name, factory in self.factories:
+			setattr(s, name, factory())
+
+# Read-only files are mapped once and the mapping is shared by every unpack
+# from the same file object; positions within the mapping are file offsets.
+mappings = weakref.WeakKeyDictionary()
+
+def isFile(data):
+	return hasattr(data, 'read') and not isinstance(data, mmap.mmap)
+
+def mapFile(fp):
+	try:
+		return mappings[fp]
+	except (KeyError, TypeError):
+		pass
+
+	try:
+		buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+	except (AttributeError, EnvironmentError, ValueError):
+		pos = fp.tell()
+		fp.seek(0)
+		buf = fp.read()
+		fp.seek(pos)
+		return buf
+
+	mode = getattr(fp, 'mode', '')
+	if 'r' in mode and '+' not in mode:
+		try:
+			mappings[fp] = buf
+		except TypeError:
+			pass
+	return buf
+
+# Random-access view over `count` consecutive fixed-size records.  Records are
+# decoded when indexed or iterated and the most recently indexed ones are kept
+# in a small cache; slicing decodes the selected records into a list.
+class StructArray(object):
+	cachesize = 128
+
+	def __init__(self, cls, data, offset, count):
+		self.cls = cls
+		self.data = data
+		self.offset = offset
+		self.count = count
+		self.size = cls.__getlayout__().size
+		self.cache = OrderedDict()
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in xrange(*index.indices(self.count))]
+
+		if index < 0:
+			index += self.count
+		if index < 0 or index >= self.count:
+			raise IndexError('StructArray index out of range')
+
+		try:
+			value = self.cache.pop(index)
+			self.cache[index] = value
+			return value
+		except KeyError:
+			pass
+		if len(self.cache) >= self.cachesize:
+			self.cache.popitem(last=False)
+		value = self.cache[index] = self.cls(unpack=(self.data, self.offset + index * self.size))
+		return value
+
+	def __iter__(self):
+		cls, data, offset, size, cache = self.cls, self.data, self.offset, self.size, self.cache
+		for i in xrange(self.count):
+			if i in cache:
+				yield cache[i]
+			else:
+				yield cls(unpack=(data, offset + i * size))
+
+	def __repr__(self):
+		return repr(list(self))
+
+def reserve(buf, end):
+	if len(buf) < end:
+		buf.extend('\0' * (end - len(buf)))
+
+# Variable-size records at a known offset.  Their positions depend on the
+# sizes of the records before them, so all are decoded on first access.
+class StructList(object):
+	def __init__(self, cls, data, offset, count):
+		self.cls = cls
+		self.data = data
+		self.offset = offset
+		self.count = count
+		self.records = None
+
+	def decode(self):
+		if self.records is None:
+			records, pos = [], self.offset
+			for i in xrange(self.count):
+				records.append(self.cls(unpack=(self.data, pos)))
+				pos += len(records[-1])
+			self.records = records
+		return self.records
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, index):
+		return self.decode()[index]
+
+	def __iter__(self):
+		return iter(self.decode())
+
+	def __repr__(self):
+		return repr(self.decode())
+
+def arraycode(code):
+	size = struct.calcsize('<' + code)
+	for typecode in dict(b='b', B='B', h='h', H='H', i='il', I='IL', l='il', L='IL', q='l', Q='L', f='f', d='d').get(code, ''):
+		if array.array(typecode).itemsize == size:
+			return typecode
+	raise StructException('No array.array type for %r' % code)
+
+def itemsize(stype):
+	stype = tuple(stype)
+	if stype[0] == 'struct':
+		return stype[1].__getlayout__().size
+	elif stype[0] == 'string':
+		return None
+	return stype[1]
+
 class BaseStruct(object):
-	__slots__ = ('_ignore', '__attrs__', '__baked__', '__defs__', '__endian__', '__format_func__', '__fp__', '__frame__', '__next__', '__odefs__', '__pos__', '__sizes__', '__startpos__', '__triggers__', '__values__')
+	__slots__ = ('__pos__', '__startpos__')
 	
 	LE = '<'
 	BE = '>'
+	_ignore = False
 	__endian__ = '<'
 	__format_func__ = None
 	__framestack__ = []
 	__structstack__ = []
 
+	def __new__(cls, *args, **kwargs):
+		return object.__new__(cls.__getlayout__().record)
+
 	def __init__(self, unpack=None, **kwargs):
-		BaseStruct.__structstack__.append(self)
-		self.__baked__ = False
-		self.__defs__ = []
-		self.__odefs__ = {}
-		self.__sizes__ = []
-		self.__attrs__ = []
-		self.__values__ = {}
-		self.__next__ = True
-		self._ignore = False
-
-		self.__triggers__ = {}
-		
-		if self.__format_func__ is not None:
-			self.__frame__ = None
-			sys.settrace(self.__trace__)
-			if self.__format_func__.func_code.co_argcount == 1:
-				self.__format_func__.im_func(nameSurrogate)
-			else:
-				self.__format_func__.im_func()
-			sys.settrace(None)
-			BaseStruct.__framestack__.pop()
-			varnames = self.__format_func__.func_code.co_varnames[self.__format_func__.func_code.co_argcount:]
-			for name in varnames:
-				value = self.__frame__.f_locals[name]
-				self.__odefs__[name] = value
-				self.__setattr__(name, value)
-
-		self.__baked__ = True
-		
 		if unpack != None:
 			if isinstance(unpack, tuple):
 				self.unpack(*unpack)
 			else:
 				self.unpack(unpack)
+		else:
+			self.__getlayout__().init(self)
 		
 		if len(kwargs):
 			for name in kwargs:
-				self.__values__[name] = kwargs[name]
+				setattr(self, name, kwargs[name])
 
-		BaseStruct.__structstack__.pop()
-	
-	def __trace__(self, frame, event, arg):
-		if self.__frame__ is None:
-			self.__frame__ = frame
-			BaseStruct.__framestack__.append(frame)
-
-	def __setattr__(self, name, value):
-		if name in self.__slots__:
-			return object.__setattr__(self, name, value)
-		if self.__baked__ == False:
-			if not isinstance(value, list):
-				value = [value]
-				attrname = name
-			else:
-				attrname = '*' + name
-			
-			self.__values__[name] = None
-			
-			for sub in value:
-				if isinstance(sub, BaseStruct):
-					sub = sub.__class__
-				try:
-					if issubclass(sub, BaseStruct):
-						sub = ('struct', sub)
-				except TypeError:
-					pass
-				type_, size = tuple(sub)
-				if type_ == 'string':
-					self.__defs__.append(string)
-					self.__sizes__.append(size)
-					self.__attrs__.append(attrname)
-					self.__next__ = True
-					
-					if attrname[0] != '*':
-						self.__values__[name] = size[3]
-					elif self.__values__[name] == None:
-						self.__values__[name] = [size[3] for val in value]
-				elif type_ == 'struct':
-					self.__defs__.append(BaseStruct)
-					self.__sizes__.append(size)
-					self.__attrs__.append(attrname)
-					self.__next__ = True
-					
-					if attrname[0] != '*':
-						self.__values__[name] = size()
-					elif self.__values__[name] == None:
-						self.__values__[name] = [size() for val in value]
-				elif type_ == 'array':
-					stype, size = size
-					if isinstance(size, tuple):
-						if hasattr(size, '__fieldname__'):
-							obj, attr = self, size.__fieldname__
-						else:
-							obj, attr = size
-						self.__defs__.append(ArrayType(stype, obj, attr))
-					elif isinstance(size, str):
-						self.__defs__.append(ArrayType(stype, self, size))
-					elif callable(size):
-						self.__defs__.append(ExprArrayType(stype, self, size))
-					else:
-						self.__defs__.append(ConstantArrayType(stype, size))
-					self.__sizes__.append(None)
-					self.__attrs__.append(attrname)
-					self.__values__[attrname] = []
-				else:
-					if self.__next__:
-						self.__defs__.append('')
-						self.__sizes__.append(0)
-						self.__attrs__.append([])
-						self.__next__ = False
-					
-					self.__defs__[-1] += type_
-					self.__sizes__[-1] += size
-					self.__attrs__[-1].append(attrname)
-					
-					if attrname[0] != '*':
-						self.__values__[name] = 0
-					elif self.__values__[name] == None:
-						self.__values__[name] = [0 for val in value]
-		else:
-			try:
-				self.__values__[name] = value
-			except KeyError:
-				raise AttributeError(name)
+	@classmethod
+	def __getlayout__(cls):
+		layout = cls.__dict__.get('__layout__')
+		if layout is None:
+			layout = Layout(cls)
+			cls.__layout__ = layout
+		return layout
 
-	def trigger_after(self, name, cb):
-		if name not in self.__triggers__:
-			self.__triggers__[name] = []
-		self.__triggers__[name].append(cb)
-	
-	def __getattr__(self, name):
-		try:
-			return self.__values__[name]
-		except KeyError:
-			raise AttributeError(name)
-	
 	def __len__(self):
+		layout = self.__getlayout__()
+		if layout.size is not None:
+			return layout.size
+		if layout.extent is not None:
+			return getattr(self, layout.extent)
+
 		ret = 0
-		arraypos, arrayname = None, None
-		
-		for i in range(len(self.__defs__)):
-			sdef, size, attrs = self.__defs__[i], self.__sizes__[i], self.__attrs__[i]
-			
-			if sdef == string:
-				size, offset, encoding, nullTerm, stripNulls, value = size
+		for kind, arg, name, islist, size, triggers in layout.ops:
+			if kind == STRING:
+				size, offset = arg[:2]
 				if isinstance(size, str):
-					size = self.__values__[size] + offset
-			elif sdef == BaseStruct:
-				if attrs[0] == '*':
-					if arrayname != attrs:
-						arrayname = attrs
-						arraypos = 0
-					size = len(self.__values__[attrs[1:]][arraypos])
-				size = len(self.__values__[attrs])
-			elif isinstance(sdef, ArrayType):
-				stype = tuple(sdef.type)
-				size = sum(stype[1] if stype[0] != 'struct' else len(x) for x in self.__values__[attrs])
+					size = getattr(self, size) + offset
+			elif kind == STRUCT:
+				if islist:
+					size = sum(len(x) for x in getattr(self, name))
+				else:
+					size = len(getattr(self, name))
+			elif kind == ARRAY:
+				if arg.offset is not None:
+					continue
+				stype = tuple(arg.type)
+				value = getattr(self, name)
+				if isinstance(value, StructArray):
+					size = len(value) * value.size
+				elif stype[0] != 'struct':
+					size = len(value) * stype[1]
+				else:
+					size = sum(len(x) for x in value)
 			
 			ret += size
 		
@@ -307,54 +628,61 @@ class BaseStruct(object):
 		return self.__str__(multiline=False)
 
 	def __str__(self, multiline=True, level=1):
-		kv = []
-		for attrs in self.__attrs__:
-			if isinstance(attrs, list):
-				for attr in attrs:
-					if attr[0] == '*':
-						if len(kv) == 0 or kv[-1][0] != attr[1:]:
-							kv.append((attr[1:], self.__values__[attr[1:]]))
-					else:
-						kv.append((attr, self.__values__[attr]))
-			else:
-				kv.append((attrs, self.__values__[attrs]))
+		kv = [(name, getattr(self, name)) for name in self.__getlayout__().names]
 
 		if not multiline or len(kv) < 2:
 			return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % (k, v) for k, v in kv))
 		else:
 			return '%s(\n%s\n)' % (self.__class__.__name__, '\n'.join('%s%s=%s%s' % ('\t' * level, k, v.__str__(multiline=True, level=level+1) if isinstance(v, BaseStruct) else `v`, ', ' if i != len(kv) - 1 else ' ') for i, (k, v) in enumerate(kv)))
 
-	def unpack(self, data, pos=0):
-		self.__pos__ = pos
-		is_file = isinstance(data, file)
-		if is_file:
-			self.__fp__ = data
-		else:
-			self.__fp__ = None
-		self.__startpos__ = self.tell()
-		for name in self.__values__:
-			if not isinstance(self.__values__[name], BaseStruct):
-				self.__values__[name] = None
-			elif self.__values__[name].__class__ == list and len(self.__values__[name]) != 0:
-				if not isinstance(self.__values__[name][0], BaseStruct):
-					self.__values__[name] = None
+	# Sources can be anything struct.unpack_from accepts (str, bytearray, mmap,
+	# buffer, memoryview) or a file object.  Files are memory mapped once and
+	# decoded in place, from pos if given and the current position otherwise,
+	# then left positioned after the record.
+	def unpack(self, data, pos=None):
+		fp = None
+		if isFile(data):
+			fp, data = data, mapFile(data)
+			if pos is None:
+				pos = fp.tell()
+		elif pos is None:
+			pos = 0
+
+		self.__getlayout__().decoder()(self, data, pos)
+
+		if fp is not None:
+			fp.seek(self.__pos__)
 		
-		arraypos, arrayname = None, None
-		
-		for i in range(len(self.__defs__)):
-			sdef, size, attrs = self.__defs__[i], self.__sizes__[i], self.__attrs__[i]
+		return self
 
-			if sdef == string:
-				size, offset, encoding, nullTerm, stripNulls, value = size
+	# Reference decoder that walks the compiled ops; used whenever no generated
+	# decoder is available for the layout.
+	def __interpret__(self, data, pos):
+		layout = self.__getlayout__()
+		self.__pos__ = self.__startpos__ = pos
+		for name in layout.listnames:
+			setattr(self, name, [])
+
+		for cb in layout.start_triggers:
+			cb(self)
+
+		for kind, arg, name, islist, size, triggers in layout.ops:
+			if kind == PRIMITIVE:
+				temp = arg.unpack_from(data, self.__pos__)
+				self.__pos__ += size
+				for fname, a, b in name:
+					if b is None:
+						setattr(self, fname, temp[a])
+					else:
+						setattr(self, fname, list(temp[a:b]))
+			elif kind == STRING:
+				size, offset, encoding, nullTerm, stripNulls = arg
 				if isinstance(size, str):
-					size = self.__values__[size] + offset
+					size = getattr(self, size) + offset
 				
-				if is_file:
-					temp = data.read(size)
-				else:
-					temp = data[self.__pos__:self.__pos__+size]
-				if len(temp) != size:
-					raise StructException('Expected %i byte string, got %i' % (size, len(temp)))
+				if len(data) - self.__pos__ < size:
+					raise StructException('Expected %i byte string, got %i' % (size, max(len(data) - self.__pos__, 0)))
+				temp = struct.unpack_from('%is' % size, data, self.__pos__)[0]
 				
 				if encoding != None:
 					temp = temp.decode(encoding)
@@ -364,145 +692,254 @@ class BaseStruct(object):
 				elif stripNulls:
 					temp = temp.rstrip('\0')
 
-				if attrs[0] == '*':
-					name = attrs[1:]
-					if self.__values__[name] == None:
-						self.__values__[name] = []
-					self.__values__[name].append(temp)
+				if islist:
+					getattr(self, name).append(temp)
 				else:
-					self.__values__[attrs] = temp
+					setattr(self, name, temp)
 				self.__pos__ += size
-			elif sdef == BaseStruct:
-				if attrs[0] == '*':
-					if arrayname != attrs:
-						arrayname = attrs
-						arraypos = 0
-					name = attrs[1:]
-					self.__values__[attrs][arraypos].unpack(data, self.__pos__)
-					self.__pos__ += len(self.__values__[attrs][arraypos])
-					arraypos += 1
+			elif kind == STRUCT:
+				temp = arg(unpack=(data, self.__pos__))
+				self.__pos__ += len(temp)
+				if islist:
+					getattr(self, name).append(temp)
 				else:
-					self.__values__[attrs].unpack(data, self.__pos__)
-					self.__pos__ += len(self.__values__[attrs])
-			elif isinstance(sdef, ArrayType):
-				stype = tuple(sdef.type)
-				count = sdef.count()
-				arr = self.__values__[attrs] = []
-				for i in xrange(count):
-					if stype[0] == 'struct':
-						arr.append(stype[1]().unpack(data, self.__pos__))
-						self.__pos__ += len(arr[-1])
-					elif is_file:
-						arr.append(struct.unpack(self.__endian__+stype[0], data.read(stype[1]))[0])
-					else:
-						arr.append(struct.unpack(self.__endian__+stype[0], data[self.__pos__:self.__pos__+stype[1]])[0])
+					setattr(self, name, temp)
 			else:
-				if is_file:
-					values = struct.unpack(self.__endian__+sdef, data.read(size))
+				stype = tuple(arg.type)
+				count = arg.count(self)
+				pos = self.__pos__ if arg.offset is None else self.__arraypos__(arg)
+				if stype[0] == 'struct' and itemsize(stype) is not None:
+					size = itemsize(stype)
+					if len(data) - pos < count * size:
+						raise StructException('Expected %i bytes for %s, got %i' % (count * size, name, max(len(data) - pos, 0)))
+					setattr(self, name, StructArray(stype[1], data, pos, count))
+					pos += count * size
+				elif stype[0] == 'struct' and arg.offset is not None:
+					setattr(self, name, StructList(stype[1], data, pos, count))
+				elif stype[0] == 'struct':
+					cls = stype[1]
+					arr = []
+					setattr(self, name, arr)
+					for i in xrange(count):
+						arr.append(cls(unpack=(data, pos)))
+						pos += len(arr[-1])
+				elif arg.array:
+					size = count * stype[1]
+					value = array.array(arg.typecode, struct.unpack_from('%is' % size, data, pos)[0])
+					if arg.swap:
+						value.byteswap()
+					setattr(self, name, value)
+					pos += size
 				else:
-					values = struct.unpack(self.__endian__+sdef, data[self.__pos__:self.__pos__+size])
-				self.__pos__ += size
-				j = 0
-				for name in attrs:
-					if name[0] == '*':
-						name = name[1:]
-						if self.__values__[name] == None:
-							self.__values__[name] = []
-						self.__values__[name].append(values[j])
-					else:
-						self.__values__[name] = values[j]
-					j += 1
-
-			last = attrs[-1] if isinstance(attrs, list) else attrs
-			if last in self.__triggers__:
-				for cb in self.__triggers__[last]:
-					cb(self)
-		
-		return self
+					setattr(self, name, list(struct.unpack_from('%s%i%s' % (layout.endian, count, stype[0]), data, pos)))
+					pos += count * stype[1]
+				if arg.offset is None:
+					self.__pos__ = pos
+
+			for cb in triggers:
+				cb(self)
+
+		if layout.extent is not None:
+			self.__pos__ = self.__startpos__ + len(self)
+		return self.__pos__
+
+	def __arraypos__(self, arg):
+		offset = getattr(self, arg.offset) if isinstance(arg.offset, str) else arg.offset
+		if arg.whence == ABSOLUTE:
+			return offset
+		elif arg.whence == STRUCT_RELATIVE:
+			return self.__startpos__ + offset
+		return self.__pos__ + offset
 
 	def seek(self, pos):
-		if self.__fp__ is None:
-			self.__pos__ = pos
-		else:
-			self.__fp__.seek(pos)
+		self.__pos__ = pos
 
 	def tell(self):
-		if self.__fp__ is None:
-			return self.__pos__
-		else:
-			return self.__fp__.tell()
+		return self.__pos__
 	
+	# Packs the record into a new bytearray sized by len(self).  The buffer is
+	# grown if seeks place data past that size.
 	def pack(self):
-		print 'Such deprecated.  Many unmaintained.'
-		arraypos, arrayname = None, None
+		buf = bytearray(len(self))
+		self.packInto(buf, 0, grow=True)
+		return buf
+
+	# Writes the record into a writable buffer at `offset` and returns the
+	# position after it.  Seeks are honoured exactly as in unpack.
+	def packInto(self, buf, offset=0, grow=False):
+		layout = self.__getlayout__()
+		self.__pos__ = self.__startpos__ = offset
+		listpos = {}
+
+		for cb in layout.start_triggers:
+			cb(self)
 		
-		ret = ''
-		for i in range(len(self.__defs__)):
-			sdef, size, attrs = self.__defs__[i], self.__sizes__[i], self.__attrs__[i]
-			
-			if sdef == string:
-				size, offset, encoding, nullTerm, stripNulls, value = size
+		for kind, arg, name, islist, size, triggers in layout.ops:
+			if kind == PRIMITIVE:
+				values = []
+				for fname, a, b in name:
+					if b is None:
+						values.append(getattr(self, fname))
+					else:
+						values += getattr(self, fname)
+				
+				if grow:
+					reserve(buf, self.__pos__ + size)
+				arg.pack_into(buf, self.__pos__, *values)
+				self.__pos__ += size
+			elif kind == STRING:
+				size, offset, encoding, nullTerm, stripNulls = arg
 				if isinstance(size, str):
-					size = self.__values__[size]+offset
+					size = getattr(self, size)+offset
 				
-				if attrs[0] == '*':
-					if arrayname != attrs:
-						arraypos = 0
-						arrayname = attrs
-					temp = self.__values__[attrs[1:]][arraypos]
-					arraypos += 1
+				if islist:
+					i = listpos[name] = listpos.get(name, -1) + 1
+					temp = getattr(self, name)[i]
 				else:
-					temp = self.__values__[attrs]
+					temp = getattr(self, name)
 				
 				if encoding != None:
 					temp = temp.encode(encoding)
 				
-				temp = temp[:size]
-				ret += temp + ('\0' * (size - len(temp)))
-			elif sdef == BaseStruct:
-				if attrs[0] == '*':
-					if arrayname != attrs:
-						arraypos = 0
-						arrayname = attrs
-					ret += self.__values__[attrs[1:]][arraypos].pack()
-					arraypos += 1
+				if grow:
+					reserve(buf, self.__pos__ + size)
+				struct.pack_into('%is' % size, buf, self.__pos__, temp)
+				self.__pos__ += size
+			elif kind == STRUCT:
+				if islist:
+					i = listpos[name] = listpos.get(name, -1) + 1
+					temp = getattr(self, name)[i]
 				else:
-					ret += self.__values__[attrs].pack()
+					temp = getattr(self, name)
+				temp.packInto(buf, self.__pos__, grow)
+				self.__pos__ += len(temp)
 			else:
-				values = []
-				for name in attrs:
-					if name[0] == '*':
-						if arrayname != name:
-							arraypos = 0
-							arrayname = name
-						values.append(self.__values__[name[1:]][arraypos])
-						arraypos += 1
+				stype = tuple(arg.type)
+				value = getattr(self, name)
+				pos = self.__pos__ if arg.offset is None else self.__arraypos__(arg)
+				if stype[0] == 'struct':
+					for temp in value:
+						temp.packInto(buf, pos, grow)
+						pos += len(temp)
+				else:
+					size = len(value) * stype[1]
+					if grow:
+						reserve(buf, pos + size)
+					if isinstance(value, array.array) and value.itemsize == stype[1]:
+						if arg.swap:
+							value = array.array(value.typecode, value)
+							value.byteswap()
+						struct.pack_into('%is' % size, buf, pos, value.tostring())
 					else:
-						values.append(self.__values__[name])
-				
-				ret += struct.pack(self.__endian__+sdef, *values)
-		return ret
+						struct.pack_into('%s%i%s' % (layout.endian, len(value), stype[0]), buf, pos, *value)
+					pos += size
+				if arg.offset is None:
+					self.__pos__ = pos
+
+			for cb in triggers:
+				cb(self)
+
+		if layout.extent is not None:
+			self.__pos__ = self.__startpos__ + len(self)
+		return self.__pos__
+
+	# Packs a sequence of records, or a numpy array convertible to this struct's
+	# dtype, into one contiguous bytearray.
+	@classmethod
+	def packArray(cls, records):
+		if np is not None and isinstance(records, np.ndarray):
+			dtype = cls.numpyDtype()
+			buf = bytearray(len(records) * dtype.itemsize)
+			np.frombuffer(buf, dtype)[:] = records
+			return buf
+
+		size = cls.__getlayout__().size
+		if size is None:
+			buf = bytearray(sum(len(record) for record in records))
+			pos = 0
+			for record in records:
+				record.packInto(buf, pos, grow=True)
+				pos += len(record)
+		else:
+			buf = bytearray(len(records) * size)
+			for i, record in enumerate(records):
+				record.packInto(buf, i * size)
+		return buf
 	
 	def __getitem__(self, value):
-		return IgnorableTuple(('array', (('struct', self.__class__), value)))
+		return IgnorableTuple(('array', (('struct', self.__getlayout__().cls), value)))
 
 	def __call__(self, func):
-		return type(func.__name__, (BaseStruct, ), dict(__format_func__=func))
+		return type(func.__name__, (BaseStruct, ), dict(__format_func__=func, __slots__=(), __module__=func.__module__))
+
+	@classmethod
+	def numpyDtype(cls):
+		return cls.__getlayout__().dtype()
+
+	# Decodes `count` consecutive records (all remaining data if negative) into
+	# a numpy structured array in a single pass, without copying the source.
+	# Files are read from `offset`, or from their current position if it is
+	# None.
+	@classmethod
+	def unpackArray(cls, data, count=-1, offset=None):
+		dtype = cls.numpyDtype()
+		fp = None
+		if isFile(data):
+			fp, data = data, mapFile(data)
+			if offset is None:
+				offset = fp.tell()
+		elif offset is None:
+			offset = 0
+
+		if count < 0:
+			count = (len(data) - offset) / dtype.itemsize
+		if len(data) - offset < count * dtype.itemsize:
+			raise StructException('Expected %i bytes, got %i' % (count * dtype.itemsize, len(data) - offset))
+		if fp is not None:
+			fp.seek(offset + count * dtype.itemsize)
+		if isinstance(data, memoryview):
+			return np.asarray(data)[offset:offset + count * dtype.itemsize].view(dtype)
+		return np.frombuffer(data, dtype, count, offset)
+
+	# Like unpackArray, but returns a StructArray that decodes records on demand.
+	@classmethod
+	def unpackLazy(cls, data, count=-1, offset=None):
+		size = cls.__getlayout__().size
+		if size is None:
+			raise StructException('%s is not a fixed-size struct' % cls.__name__)
+		fp = None
+		if isFile(data):
+			fp, data = data, mapFile(data)
+			if offset is None:
+				offset = fp.tell()
+		elif offset is None:
+			offset = 0
+
+		if count < 0:
+			count = (len(data) - offset) / size
+		if len(data) - offset < count * size:
+			raise StructException('Expected %i bytes, got %i' % (count * size, len(data) - offset))
+		if fp is not None:
+			fp.seek(offset + count * size)
+		return StructArray(cls, data, offset, count)
 
 	def toDict(self, recursive=True, attrs=True):
 		def conv(obj):
-			if isinstance(obj, list):
+			if isinstance(obj, (list, StructArray, StructList)):
 				return map(conv, obj)
+			elif isinstance(obj, array.array):
+				return obj.tolist()
 			elif isinstance(obj, BaseStruct):
 				return obj.toDict(attrs=attrs)
 			else:
 				return obj
+		layout = self.__getlayout__()
 		df = AttrDict if attrs else dict
 		if recursive:
-			return df({ k:conv(v) for k, v in self.__values__.items() if not self.__odefs__[k]._ignore})
+			return df({ k:conv(getattr(self, k)) for k in layout.names if k not in layout.ignored})
 		else:
-			return df({ k:v for k, v in self.__values__.items() if not self.__odefs__[k]._ignore})
+			return df({ k:getattr(self, k) for k in layout.names if k not in layout.ignored})
 
 Struct = BaseStruct()
 
-__all__ = 'string sbyte schar int8 byte char uint8 short int16 ushort uint16 sint int32 uint uint32 int64 uint64 float vec2 vec3 vec4 Struct StructException STRUCT_RELATIVE RELATIVE ABSOLUTE struct_seek'.split(' ')
+__all__ = 'string sbyte schar int8 byte char uint8 short int16 ushort uint16 sint int32 uint uint32 int64 uint64 float vec2 vec3 vec4 Struct StructArray StructList StructException STRUCT_RELATIVE RELATIVE ABSOLUTE struct_seek struct_size'.split(' ')
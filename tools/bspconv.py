@@ -1,7 +1,10 @@
 from Struct import *
-import copy, json, pprint, sys
+import __builtin__, argparse, copy, itertools, json, re
 import numpy as np
 from assets import AssetManager
+from container import ContainerWriter
+from outfile import atomicFile, JsonStream
+import imagebuf, meshopt, quantize
 
 @Struct
 def Direntry():
@@ -103,201 +106,435 @@ def Face():
 
 @Struct
 def Lightmap():
-	pixels = uint8[128*128*3]
+	pixels = uint8[128*128*3].array
+
+@Struct
+def VisData(self):
+	n_vecs, sz_vecs = int32[2]
+	vecs = uint8[lambda self: self.n_vecs * self.sz_vecs].array
 
 rotmat = np.array([
 	[1.0000000,  0.0000000,  0.0000000], 
 	[0.0000000,  0.0000000, -1.0000000], 
 	[0.0000000,  1.0000000,  0.0000000]])
 
-# ind, verts = tesselate(face.size, fv, fmv)
-# this function is directly adapted from http://media.tojicode.com/q3bsp/js/q3bsp_worker.js
-def tesselate(size, verts, meshverts):
-	def getPoint(c0, c1, c2, dist):
-		def sub(attr):
-			v0, v1, v2 = map(np.array, (getattr(c0, attr), getattr(c1, attr), getattr(c2, attr)))
-			b = 1 - dist
-
-			vc = v0 * (b * b) + v1 * (2 * b * dist) + v2 * (dist * dist)
-			if attr == 'normal':
-				mag = np.linalg.norm(vc)
-				if mag != 0:
-					vc /= mag
-			setattr(outvert, attr, vc.tolist())
-
-		outvert = Vertex()
-		sub('position')
-		sub('texcoord')
-		sub('lmcoord')
-		sub('color')
-		sub('normal')
-		return outvert
-
-	level = 5.
-	L1 = int(level) + 1
-
-	for py in xrange(0, size[1]-2, 2):
-		for px in xrange(0, size[0]-2, 2):
-			rowOff = py * size[0]
-
-			c0, c1, c2 = verts[rowOff + px:rowOff + px + 3]
-			rowOff += size[0]
-			c3, c4, c5 = verts[rowOff + px:rowOff + px + 3]
-			rowOff += size[0]
-			c6, c7, c8 = verts[rowOff + px:rowOff + px + 3]
-
-			indexOff = len(verts)
-
-			for i in xrange(L1):
-				a = i / level
-				verts.append(getPoint(c0, c3, c6, a))
-
-			for i in xrange(1, L1):
-				a = i / level
-
-				tc0 = getPoint(c0, c1, c2, a)
-				tc1 = getPoint(c3, c4, c5, a)
-				tc2 = getPoint(c6, c7, c8, a)
-
-				for j in xrange(L1):
-					b = j / level
-
-					verts.append(getPoint(tc0, tc1, tc2, b))
-
-			for row in xrange(int(level)):
-				for col in xrange(int(level)):
-					meshverts.append(indexOff + (row + 1) * L1 + col)
-					meshverts.append(indexOff + row * L1 + col)
-					meshverts.append(indexOff + row * L1 + col + 1)
-					
-					meshverts.append(indexOff + (row + 1) * L1 + col)
-					meshverts.append(indexOff + row * L1 + col + 1)
-					meshverts.append(indexOff + (row + 1) * L1 + col + 1)
-
-	return meshverts, verts
+# Quadratic Bernstein weights for level + 1 evenly spaced steps, one row per step.
+def bernstein(level):
+	t = np.linspace(0, 1, level + 1)
+	b = 1 - t
+	return np.array([b * b, 2 * b * t, t * t]).T
+
+patchAttributes = 'position', 'texcoord', 'lmcoord', 'color', 'normal'
+
+# Picks subdivision levels for each column and row of 3x3 sections in a patch.
+# A quadratic curve split into n segments strays at most |p0 - 2p1 + p2| / 4n^2
+# from them, so with a tolerance the level is at least the smallest n keeping
+# that within it.  With a maxEdge, it is also enough to keep segments along the
+# control polygon no longer than that, so large, nearly flat sections still get
+# the vertices their lighting and colours are interpolated across.  Sections in
+# the same column (or row) share their edges along it, so they are given the
+# same level there and no cracks open up between them.
+def patchLevels(size, positions, minLevel, maxLevel, tolerance=None, maxEdge=None):
+	width, height = size
+	grid = positions.reshape(height, width, 3).astype(np.float64)
+	norm = lambda v: np.sqrt((v * v).sum(axis=-1))
+
+	def levels(p0, p1, p2):
+		level = np.zeros(p0.shape[:-1])
+		if tolerance is not None:
+			level = np.sqrt(norm(p0 - 2 * p1 + p2) / 4 / tolerance)
+		if maxEdge is not None:
+			level = np.maximum(level, (norm(p1 - p0) + norm(p2 - p1)) / maxEdge)
+		return np.clip(np.ceil(level), minLevel, maxLevel).astype(int)
+
+	levelsU = levels(grid[:, 0:-2:2], grid[:, 1:-1:2], grid[:, 2::2]).max(axis=0)
+	levelsV = levels(grid[0:-2:2], grid[1:-1:2], grid[2::2]).max(axis=1)
+	return levelsU, levelsV
+
+# ind, verts = tesselate(face.size, fv)
+# Evaluates the 3x3 control grids of a patch in batches of equal level; verts is
+# a slice of the vertex lump as a numpy array.  levels is a (u, v) pair of
+# levels, either single values or one per column/row of sections as from
+# patchLevels.  Returns the indices and a dict of float64 attribute arrays.
+# Vertex order and winding match q3bsp_worker.js, see
+# http://media.tojicode.com/q3bsp/js/q3bsp_worker.js
+def tesselate(size, verts, levels=(5, 5)):
+	width, height = size
+
+	py, px = np.meshgrid(np.arange(0, height - 2, 2), np.arange(0, width - 2, 2), indexing='ij')
+	levelsU = np.broadcast_to(levels[0], px.shape[1:])[px // 2].ravel()
+	levelsV = np.broadcast_to(levels[1], py.shape[:1])[py // 2].ravel()
+	steps = np.arange(3)
+	# (patch, row, column) indices of the control points
+	control = (py.reshape(-1, 1, 1) + steps.reshape(1, 3, 1)) * width + px.reshape(-1, 1, 1) + steps.reshape(1, 1, 3)
+
+	outverts = dict((attr, []) for attr in patchAttributes)
+	indices = []
+	count = 0
+	for levelU, levelV in sorted(set(zip(levelsU, levelsV))):
+		batch = control[(levelsU == levelU) & (levelsV == levelV)]
+		patches = len(batch)
+		basisU, basisV = bernstein(levelU), bernstein(levelV)
+		L1 = levelV + 1
+		size = (levelU + 1) * L1
+
+		for attr in patchAttributes:
+			points = verts[attr][batch].astype(np.float64)
+			# Columns are interpolated with the outer step, rows with the inner one.
+			points = np.einsum('ic,jr,prcd->pijd', basisU, basisV, points)
+			outverts[attr].append(points.reshape(patches * size, -1))
+
+		row, col = np.mgrid[:levelU, :levelV]
+		quad = row * L1 + col
+		quad = np.dstack((quad + L1, quad, quad + 1, quad + L1, quad + 1, quad + L1 + 1)).ravel()
+		indices.append((count + np.arange(patches).reshape(-1, 1) * size + quad).ravel())
+		count += patches * size
+
+	outverts = dict((attr, np.concatenate(arrays)) for attr, arrays in outverts.items())
+	normals = outverts['normal']
+	mag = np.sqrt((normals * normals).sum(axis=1))
+	nonzero = mag != 0
+	normals[nonzero] /= mag[nonzero, np.newaxis]
+
+	return np.concatenate(indices), outverts
 
 def rewind(data, xmod=1):
 	return data
-	out = []
-	for i in xrange(0, len(data), 3):
-		out += [xmod * data[i+0], data[i+2], data[i+1]]
-	return out
+	out = np.reshape(data, (-1, 3))[:, [0, 2, 1]] * [xmod, 1, 1]
+	return out.ravel() if isinstance(data, np.ndarray) else out.ravel().tolist()
 
 def rotate(data):
 	return data
-	out = []
-	for i in xrange(0, len(data), 3):
-		vec = np.array(data[i:i+3])
-		out += list(rotmat.dot(vec))
-	return out
-
-def interleave(count, *elems):
-	out = []
-	elemsize = [len(x) / count for x in elems]
-
+	out = np.dot(np.reshape(data, (-1, 3)), rotmat.T).reshape(np.shape(data))
+	return out if isinstance(data, np.ndarray) else out.tolist()
+
+# Splits an (n, stride) vertex array into one mesh per index array, all in one
+# pass.  Each mesh keeps only the vertices it uses, in order of first use, and
+# its indices are remapped to match.  Returns (indices, vertices) per mesh.
+def splitMeshes(indexArrays, vertices):
+	if not indexArrays:
+		return []
+	lengths = [len(x) for x in indexArrays]
+	stride = max(len(vertices), 1)
+	buckets = np.repeat(np.arange(len(indexArrays)), lengths)
+	keys = buckets * stride + np.concatenate(indexArrays).astype(np.int64)
+
+	keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+	# Keys sort by mesh and then by index; reorder them by first use instead.
+	order = np.argsort(first)
+	rank = np.empty_like(order)
+	rank[order] = np.arange(len(order))
+	counts = np.bincount(keys // stride, minlength=len(indexArrays))
+	starts = np.cumsum(counts) - counts
+
+	indices = rank[inverse] - starts[buckets]
+	vertices = vertices[keys[order] % stride]
+	return zip(np.split(indices, np.cumsum(lengths)[:-1]), np.split(vertices, np.cumsum(counts)[:-1]))
+
+# Packs (n, 10) map vertices as float positions, octahedral normals, float
+# texcoords and unorm16 lightmap coordinates.  World coordinates need more than
+# 16 bits, and so do texcoords, which tile far past [0, 1] where 16 bit formats
+# lose precision; lightmap coordinates stay within [0, 1].
+def packVertices(vertices):
+	return quantize.interleave([
+		('Position', vertices[:, 0:3].astype(np.float32), False, {}), 
+		('Normal', quantize.octEncode(vertices[:, 3:6]), True, dict(Encoding='octahedral')), 
+		('Texcoord', vertices[:, 6:8].astype(np.float32), False, {}), 
+		('LightmapTexcoord', quantize.unorm16(vertices[:, 8:10]), True, {}), 
+	])
+
+# Packs an (n, height, width, channels) lightmap array into pages of at most
+# size texels square, in a grid of cells that pad each lightmap with copies of
+# its edge texels so filtering does not pick up its neighbours.  Pages are full
+# grids but for the last, which gets the smallest grid that holds what is left,
+# so page sizes need not be powers of two.  Returns the pages, each page's
+# (width, height), and each lightmap's page and texel offset as (n, 3) rows.
+def atlasLightmaps(lightmaps, size, padding=1):
+	count, height, width, channels = lightmaps.shape
+	cellw, cellh = width + 2 * padding, height + 2 * padding
+	maxCols, maxRows = size // cellw, size // cellh
+	if not maxCols or not maxRows:
+		raise ValueError('Atlas pages of %i texels cannot hold a %ix%i lightmap' % (size, width, height))
+
+	# Fewest cells, then the squarest page.
+	def grid(n):
+		shapes = [(cols, -(-n // cols)) for cols in xrange(1, min(n, maxCols) + 1) if -(-n // cols) <= maxRows]
+		return min(shapes, key=lambda shape: (shape[0] * shape[1], abs(shape[0] * cellw - shape[1] * cellh)))
+
+	perPage = maxCols * maxRows
+	page, slot = np.divmod(np.arange(count), perPage)
+	grids = [grid(min(perPage, count - first)) for first in xrange(0, count, perPage)]
+	cols = np.array([cols for cols, rows in grids], dtype=np.int64)[page]
+	x, y = slot % cols * cellw, slot // cols * cellh
+
+	padded = np.pad(lightmaps, ((0, 0), (padding, padding), (padding, padding), (0, 0)), 'edge')
+	pages = [np.zeros((rows * cellh, cols * cellw, channels), dtype=lightmaps.dtype) for cols, rows in grids]
 	for i in xrange(count):
-		for j, elem in enumerate(elems):
-			size = elemsize[j]
-			start = size * i
-			out += elem[start:start+size]
-
-	return out
-
-def splitMesh(indices, vertices, stride):
-	indmap = {}
-	outindices = []
-	outvertices = []
-
-	for ind in indices:
-		if ind in indmap:
-			outindices.append(indmap[ind])
+		pages[page[i]][y[i]:y[i] + cellh, x[i]:x[i] + cellw] = padded[i]
+	sizes = np.array([(cols * cellw, rows * cellh) for cols, rows in grids], dtype=np.int64).reshape(-1, 2)
+	return pages, sizes, np.column_stack((page, x + padding, y + padding))
+
+# Brightens an (n, height, width, 3) lightmap array by the overbright shift.
+# Saturated pixels are scaled back down as a whole so they keep their hue.
+def adjustBrightness(pixels, shift=2, gamma=1.):
+	pixels = pixels.astype(np.float64) * (1 << shift)
+	peak = pixels.max(axis=-1)
+	scale = 255 / np.maximum(peak, 255)
+	pixels *= scale[..., np.newaxis]
+	if gamma != 1:
+		pixels = 255 * (pixels / 255) ** (1. / gamma)
+	return pixels.astype(np.uint8)
+
+# Corners of the convex brush bounded by the given planes: every point where
+# three planes meet that lies on or behind all of them.
+def brushPoints(normals, dists):
+	if len(normals) < 4:
+		return np.zeros((0, 3))
+	triples = np.array(list(itertools.combinations(xrange(len(normals)), 3)))
+	systems = normals[triples]
+	solvable = np.abs(np.linalg.det(systems)) > 1e-9
+	if not solvable.any():
+		return np.zeros((0, 3))
+	points = np.linalg.solve(systems[solvable], dists[triples[solvable]])
+	inside = (np.dot(points, normals.T) - dists <= 0.01).all(axis=1)
+	return points[inside]
+
+def snap(values, epsilon=1e-3):
+	rounded = np.round(values)
+	return np.where(np.abs(values - rounded) < epsilon, rounded, values) + 0.
+
+axialNormals = np.vstack((-np.eye(3), np.eye(3)))
+
+# Prepares the brushes for collision.  Non-solid brushes are dropped, each
+# remaining brush gets its bounds and any of the six axial bevel planes it is
+# missing, and duplicate planes are merged, keeping only those brushes and
+# nodes use.  Returns the planes as (n, 4) rows of normal and distance, each
+# kept brush's plane indices and bounds, and maps from old brush and plane
+# indices to new ones (-1 where dropped).
+def prepareCollision(planes, brushes, brushsides, contents, nodeplanes):
+	rows = np.column_stack((planes['normal'], planes['dist'])).astype(np.float32)
+	solid = (contents[brushes['texture']] & 1) == 1
+	brushmap = np.zeros(len(brushes), dtype=np.int64) - 1
+	brushmap[solid] = np.arange(solid.sum())
+
+	bevels = []
+	brushplanes = []
+	mins = np.zeros((solid.sum(), 3), dtype=np.float32)
+	maxs = np.zeros((solid.sum(), 3), dtype=np.float32)
+	for i, (first, count) in enumerate(zip(brushes['brushside'][solid], brushes['n_brushsides'][solid])):
+		sides = brushsides['plane'][first:first+count]
+		normals, dists = rows[sides, :3].astype(np.float64), rows[sides, 3].astype(np.float64)
+		sides = sides.tolist()
+		points = brushPoints(normals, dists)
+		if len(points):
+			mins[i], maxs[i] = snap(points.min(axis=0)), snap(points.max(axis=0))
+			for normal, dist in zip(axialNormals, np.concatenate((-mins[i], maxs[i]))):
+				if not (normals == normal).all(axis=1).any():
+					sides.append(len(rows) + len(bevels))
+					bevels.append(np.append(normal, dist))
+		brushplanes.append(sides)
+	if bevels:
+		rows = np.vstack((rows, np.array(bevels, dtype=np.float32)))
+
+	# Adding 0 turns -0.0 into 0.0, so planes that differ only in that match.
+	keys = np.ascontiguousarray(rows + np.float32(0)).view(np.dtype((np.void, rows.itemsize * 4))).ravel()
+	keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+	canonical = first[inverse]
+	used = np.unique(canonical[np.concatenate([np.array(sides, dtype=np.int64) for sides in brushplanes] + [nodeplanes.astype(np.int64)])])
+	planemap = np.zeros(len(rows), dtype=np.int64) - 1
+	planemap[used] = np.arange(len(used))
+	planemap = planemap[canonical]
+
+	return dict(
+		Planes=rows[used], 
+		BrushPlanes=[planemap[sides] for sides in brushplanes], 
+		BrushMins=mins, 
+		BrushMaxs=maxs, 
+		BrushMap=brushmap, 
+		PlaneMap=planemap
+	)
+
+# Positions of the elements in the ranges [first, first + count), back to back,
+# as for each leaf's faces or brushes, along with the range each came from.
+def expandRanges(firsts, counts):
+	starts = np.cumsum(counts) - counts
+	return np.repeat(firsts - starts, counts) + np.arange(counts.sum()), np.repeat(np.arange(len(counts)), counts)
+
+# Rotates bounds into the output space, keeping mins below maxs along axes that
+# rotate flips.
+def reminmax(mins, maxs):
+	mins, maxs = rotate(mins), rotate(maxs)
+	return np.minimum(mins, maxs), np.maximum(mins, maxs)
+
+# Drops leaf references to removed brushes and renumbers the rest, returning a
+# new leaf array and LeafBrush array.
+def remapLeafBrushes(leafs, leafbrushes, brushmap):
+	positions, leafOf = expandRanges(leafs['leafbrush'], leafs['n_leafbrushes'])
+	brushes = brushmap[leafbrushes['brush'][positions]]
+	kept = brushes >= 0
+
+	leafs = leafs.copy()
+	leafs['n_leafbrushes'] = np.bincount(leafOf[kept], minlength=len(leafs))
+	leafs['leafbrush'] = np.cumsum(leafs['n_leafbrushes']) - leafs['n_leafbrushes']
+	outbrushes = np.zeros(kept.sum(), dtype=leafbrushes.dtype)
+	outbrushes['brush'] = brushes[kept]
+	return leafs, outbrushes
+
+# Flattens the tree under root into parallel arrays in depth-first order, so a
+# node's left child directly follows it.  Children >= 0 are node indices and
+# negative ones leaves, as -(leaf + 1) like in the BSP itself; each leaf's
+# brushes are a range of LeafBrushes.  Walks with an explicit stack, so deep
+# trees cannot hit the recursion limit.
+def flattenTree(nodes, leafs, leafbrushes, root=0):
+	children = nodes['children'].tolist()
+	nodeorder, leaforder = [], []
+	stack = [root]
+	while stack:
+		ind = stack.pop()
+		if ind >= 0:
+			nodeorder.append(ind)
+			stack.append(children[ind][1])
+			stack.append(children[ind][0])
 		else:
-			i = len(indmap)
-			start = ind * stride
-			outvertices += vertices[start:start + stride]
-			indmap[ind] = i
-			outindices.append(i)
-	return outindices, outvertices
-
-def adjustBrightness(pixels):
-	for i in xrange(0, len(pixels), 3):
-		r, g, b = pixels[i:i+3]
-		r, g, b = r * 4., g * 4., b * 4.
-		scale = 1.
-		if r > 255 and 255 / r < scale:
-			scale = 255 / r
-		if g > 255 and 255 / g < scale:
-			scale = 255 / g
-		if b > 255 and 255 / b < scale:
-			scale = 255 / b
-		pixels[i] = int(r * scale)
-		pixels[i+1] = int(g * scale)
-		pixels[i+2] = int(b * scale)
-	return pixels
-
-def flip(pixels, stride):
-	return reduce(lambda a, x: a + x, [pixels[i - stride:i] for i in xrange(len(pixels), 0, -stride)])
+			leaforder.append(-(ind + 1))
+	nodeorder = np.array(nodeorder, dtype=np.int64)
+	leaforder = np.array(leaforder, dtype=np.int64)
+
+	nodemap = np.zeros(len(nodes), dtype=np.int64)
+	nodemap[nodeorder] = np.arange(len(nodeorder))
+	leafmap = np.zeros(len(leafs), dtype=np.int64)
+	leafmap[leaforder] = np.arange(len(leaforder))
+	nodechildren = nodes['children'][nodeorder]
+	nodechildren = np.where(nodechildren >= 0, nodemap[np.maximum(nodechildren, 0)], -(leafmap[np.maximum(-(nodechildren + 1), 0)] + 1))
+
+	counts = leafs['n_leafbrushes'][leaforder]
+	firsts = np.cumsum(counts) - counts
+	brushes = leafbrushes['brush'][expandRanges(leafs['leafbrush'][leaforder], counts)[0]]
+
+	nodemins, nodemaxs = reminmax(nodes['mins'][nodeorder], nodes['maxs'][nodeorder])
+	leafmins, leafmaxs = reminmax(leafs['mins'][leaforder], leafs['maxs'][leaforder])
+
+	return dict(
+		NodePlanes=nodes['plane'][nodeorder], 
+		NodeChildren=nodechildren, 
+		NodeMins=nodemins, 
+		NodeMaxs=nodemaxs, 
+		LeafClusters=leafs['cluster'][leaforder], 
+		LeafMins=leafmins, 
+		LeafMaxs=leafmaxs, 
+		LeafFirstBrush=firsts, 
+		LeafBrushCount=counts, 
+		LeafBrushes=brushes
+	)
+
+# Decodes the PVS and works out which meshes can be seen from each cluster.
+# Returns, per cluster, runs of visible mesh indices as a flat
+# [first, count, first, count, ...] list.  faceMeshes maps each face to its
+# mesh, or -1 for faces without one.  Without visdata every cluster sees all.
+# The PVS is expanded blockSize rows at a time, so only that many rows of the
+# cluster by cluster matrix exist at once.
+def clusterVisibility(vis, leafs, leaffaces, faceMeshes, meshCount, blockSize=256):
+	if vis is None:
+		clusterCount = leafs['cluster'].max() + 1 if len(leafs) else 0
+		return [[0, meshCount] if meshCount else [] for i in xrange(clusterCount)]
+
+	clusterCount = vis.n_vecs
+	if vis.sz_vecs * 8 < clusterCount or len(leafs) and leafs['cluster'].max() >= clusterCount:
+		raise ValueError('Visdata for %i clusters of %i bytes does not fit the map' % (clusterCount, vis.sz_vecs))
+
+	positions, leafOf = expandRanges(leafs['leafface'], leafs['n_leaffaces'])
+	faces = leaffaces['face'][positions]
+	clusters, meshes = leafs['cluster'][leafOf], faceMeshes[faces]
+	used = (clusters >= 0) & (meshes >= 0)
+	contains = np.zeros((clusterCount, meshCount), dtype=np.float32)
+	contains[clusters[used], meshes[used]] = 1
+
+	vecs = np.frombuffer(vis.vecs, dtype=np.uint8).reshape(clusterCount, vis.sz_vecs)
+	out = []
+	for first in xrange(0, clusterCount, blockSize):
+		# Rows are bit sets with the lowest cluster in the lowest bit, while
+		# unpackbits puts the highest bit first.
+		bits = np.unpackbits(vecs[first:first + blockSize, :, np.newaxis], axis=2)[:, :, ::-1]
+		pvs = bits.reshape(len(bits), -1)[:, :clusterCount].astype(np.float32)
+		visible = np.dot(pvs, contains) > 0
+
+		# Runs start where a row steps up and end where it steps down.
+		edges = np.diff(np.pad(visible.astype(np.int8), ((0, 0), (1, 1)), 'constant'), axis=1)
+		rows, starts = np.nonzero(edges == 1)
+		ends = np.nonzero(edges == -1)[1]
+		runs = np.column_stack((starts, ends - starts))
+		out += [x.ravel().tolist() for x in np.split(runs, np.searchsorted(rows, np.arange(1, len(visible))))]
+	return out
 
+entityToken = re.compile(r'\s*(?:([{}])|"((?:[^"\\]|\\.)*)"|(\S+))')
+entityEscape = re.compile(r'\\(x..|.)')
+entityEscapes = {'n' : u'\n', 'r' : u'\r', 't' : u'\t', '0' : u'\0', '\\' : u'\\', '"' : u'"'}
+
+def unescape(match):
+	code = match.group(1)
+	if code[0] == 'x':
+		return unichr(int(code[1:]))
+	return entityEscapes.get(code, u'')
+
+def parseVector(value, size):
+	try:
+		vec = map(__builtin__.float, value.split())
+	except ValueError:
+		return None
+	return vec if len(vec) == size else None
+
+# Tokenizes the entity lump in one pass.  Returns the entities as dicts of
+# strings, a dict of entity indices by classname, and each entity's origin
+# (or None) and angle (or None).
 def parseEntities(data):
-	data = data.split('\0', 1)[0].strip()
+	data = data.split('\0', 1)[0].decode('latin-1')
 
 	entities = []
 	name = None
-	while True:
-		data = data.lstrip()
-		if len(data) == 0:
-			break
-		elif data[0] == '{':
-			data = data[1:]
+	pos = 0
+	end = len(data.rstrip())
+	while pos < end:
+		match = entityToken.match(data, pos)
+		pos = match.end()
+		brace, quoted, bare = match.groups()
+		if brace == '{':
 			entities.append({})
-		elif data[0] == '"':
-			s = ''
-			i = 1
-			while True:
-				if data[i] == '\\':
-					i += 1
-					if data[i] == 'n':
-						s += '\n'
-					elif data[i] == 'r':
-						s += '\r'
-					elif data[i] == 't':
-						s += '\t'
-					elif data[i] == '0':
-						s += '\0'
-					elif data[i] == '\\':
-						s += '\\'
-					elif data[i] == '"':
-						s += '"'
-					elif data[i] == 'x':
-						s += chr(int(data[i+1:i+3]))
-						i += 2
-					i += 1
-				elif data[i] == '"':
-					i += 1
-					break
-				else:
-					s += data[i]
-					i += 1
-			data = data[i:]
+		elif brace == '}':
+			name = None
+		else:
+			if quoted is None:
+				if bare.startswith('"'):
+					raise ValueError('Unterminated string in entity lump at %i' % match.start(3))
+				quoted = bare
+			elif '\\' in quoted:
+				quoted = entityEscape.sub(unescape, quoted)
 			if name is None:
-				name = s
+				name = quoted
 			else:
-				entities[-1][name] = s
+				entities[-1][name] = quoted
 				name = None
-		elif data[0] == '}':
-			data = data[1:]
-
-	pprint.pprint(entities)
 
-def main(path, mapname):
+	classnames = {}
+	origins = []
+	angles = []
+	for i, entity in enumerate(entities):
+		if 'classname' in entity:
+			classnames.setdefault(entity['classname'], []).append(i)
+		origins.append(parseVector(entity['origin'], 3) if 'origin' in entity else None)
+		angle = parseVector(entity['angle'], 1) if 'angle' in entity else None
+		angles.append(angle[0] if angle else None)
+	return entities, classnames, origins, angles
+
+def main(path, mapname, tessMin=1, tessMax=8, tessError=None, tessEdge=None, lmShift=2, lmGamma=1., outformat='json', binaryMeta=False, treeFormat='nested', lmAtlas=None, optimizeMeshes=False, weldEpsilon=0., quantizeVertices=False):
 	global am
 	am = AssetManager(path)
 	materials = json.load(file('materials.json'))
 
 	def decode(lump, cls):
-		size = len(cls())
-		fp.seek(header.direntries[lump].offset)
-		return [cls(unpack=fp) for i in xrange(header.direntries[lump].length / size)]
+		return cls.unpackLazy(fp, header.direntries[lump].length / len(cls()), header.direntries[lump].offset)
+
+	def decodeArray(lump, cls):
+		return cls.unpackArray(fp, header.direntries[lump].length / cls.numpyDtype().itemsize, header.direntries[lump].offset)
 
 	fp = am.fileFuzzy(mapname + '.bsp', 'rb')
 	header = Header(unpack=fp)
@@ -305,24 +542,32 @@ def main(path, mapname):
 	fp.seek(header.direntries[0].offset)
 	entities = fp.read(header.direntries[0].length)
 
-	entities = parseEntities(entities)
-	return
-	
+	entities, classnames, origins, angles = parseEntities(entities)
+
 	textures = decode(1, Texture)
-	planes = decode(2, Plane)
-	nodes = decode(3, Node)
-	leafs = decode(4, Leaf)
-	leaffaces = decode(5, LeafFace)
-	leafbrushes = decode(6, LeafBrush)
+	planes = decodeArray(2, Plane)
+	nodes = decodeArray(3, Node)
+	leafs = decodeArray(4, Leaf)
+	leaffaces = decodeArray(5, LeafFace)
+	leafbrushes = decodeArray(6, LeafBrush)
 	models = decode(7, Model)
-	brushes = decode(8, Brush)
-	brushsides = decode(9, BrushSide)
-	vertices = decode(10, Vertex)
-	meshverts = decode(11, Meshvert)
+	brushes = decodeArray(8, Brush)
+	brushsides = decodeArray(9, BrushSide)
+	vertices = decodeArray(10, Vertex)
+	meshverts = decodeArray(11, Meshvert)
 	effects = decode(12, Effect)
 	faces = decode(13, Face)
-	lightmaps = decode(14, Lightmap)
+	lightmaps = adjustBrightness(imagebuf.view(decodeArray(14, Lightmap)['pixels'], 128, 128, count=-1), lmShift, lmGamma)
+	vis = VisData(unpack=(fp, header.direntries[16].offset)) if header.direntries[16].length else None
 
+	# With an atlas, faces are keyed by atlas page rather than by lightmap, so
+	# each material needs only one mesh per page.
+	lmSizes = np.tile((128, 128), (len(lightmaps), 1))
+	if lmAtlas:
+		lightmaps, lmSizes, lmPlacement = atlasLightmaps(lightmaps, lmAtlas)
+
+	# Per-face attribute arrays and index arrays per (texture, lightmap), joined
+	# once all faces are in.
 	outindices = {}
 	outpositions = []
 	outnormals = []
@@ -331,62 +576,67 @@ def main(path, mapname):
 
 	model = models[0]
 	numverts = 0
-	for face in faces[model.face:model.face+model.n_faces]:
+	meshfaces = []
+	for i, face in enumerate(faces[model.face:model.face+model.n_faces]):
+		lmkey = face.lm_index
+		if lmAtlas and lmkey >= 0:
+			lmkey = int(lmPlacement[lmkey, 0])
 		if face.texture not in outindices:
 			outindices[face.texture] = {}
-		if face.lm_index not in outindices[face.texture]:
-			outindices[face.texture][face.lm_index] = []
-		fmv = [x.offset for x in meshverts[face.meshvert:face.meshvert+face.n_meshverts]]
+		if lmkey not in outindices[face.texture]:
+			outindices[face.texture][lmkey] = []
 		fv = vertices[face.vertex:face.vertex+face.n_vertices]
 		if face.type == 1 or face.type == 3:
-			outindices[face.texture][face.lm_index] += rewind([mv + numverts for mv in fmv], 1)
-			for vert in fv:
-				outpositions += rotate(vert.position)
-				outnormals += rotate(vert.normal)
-				outtexcoords += vert.texcoord
-				outlmcoords += vert.lmcoord
-			numverts += len(fv)
+			fmv = meshverts['offset'][face.meshvert:face.meshvert+face.n_meshverts]
 		elif face.type == 2:
-			fmv, fv = tesselate(face.size, fv, fmv)
-			outindices[face.texture][face.lm_index] += rewind([mv + numverts for mv in fmv], 1)
-			for vert in fv:
-				outpositions += rotate(vert.position)
-				outnormals += rotate(vert.normal)
-				outtexcoords += vert.texcoord
-				outlmcoords += vert.lmcoord
-			numverts += len(fv)
-		elif face.type == 4:
-			pass
+			if tessError is None and tessEdge is None:
+				levels = 5, 5
+			else:
+				levels = patchLevels(face.size, fv['position'], tessMin, tessMax, tessError, tessEdge)
+			fmv, fv = tesselate(face.size, fv, levels)
 		else:
-			print 'other', face.type
-
-	outplanes = []
-	for plane in planes:
-		outplanes.append(dict(Normal=rotate(plane.normal), Distance=plane.dist))
-	outbrushes = []
-	for brush in brushes:
-		texture = textures[brush.texture]
-		# XXX: Rewrite file so non-solid brushes are nuked.
-		collidable = (texture.content_flags & 1) == 1
-		sides = brushsides[brush.brushside:brush.brushside+brush.n_brushsides]
-		outbrushes.append(dict(Collidable=collidable, Planes=[side.plane for side in sides]))
-
-	def btree(ind):
-		def reminmax(mins, maxs):
-			mins, maxs = rotate(mins), rotate(maxs)
-			return [min(mins[0], maxs[0]), min(mins[1], maxs[1]), min(mins[2], maxs[2])], [max(mins[0], maxs[0]), max(mins[1], maxs[1]), max(mins[2], maxs[2])]
-		if ind >= 0:
-			node = nodes[ind]
-			mins, maxs = reminmax(node.mins, node.maxs)
-			return dict(Leaf=False, Plane=node.plane, Mins=mins, Maxs=maxs, Left=btree(node.children[0]), Right=btree(node.children[1]))
+			if face.type != 4:
+				print 'other', face.type
+			continue
+
+		outindices[face.texture][lmkey].append(rewind(fmv + numverts, 1))
+		meshfaces.append((model.face + i, face.texture, lmkey))
+		outpositions.append(rotate(fv['position']))
+		outnormals.append(rotate(fv['normal']))
+		outtexcoords.append(fv['texcoord'])
+		if lmAtlas and face.lm_index >= 0:
+			outlmcoords.append((fv['lmcoord'] * (128, 128) + lmPlacement[face.lm_index, 1:]) / lmSizes[lmkey].astype(np.float64))
 		else:
-			leaf = leafs[-(ind + 1)]
-			mins, maxs = reminmax(leaf.mins, leaf.maxs)
-			return dict(Leaf=True, Plane=-1, Mins=mins, Maxs=maxs, Brushes=[x.brush for x in leafbrushes[leaf.leafbrush:leaf.leafbrush+leaf.n_leafbrushes]])
-
-	outvertices = interleave(len(outpositions) / 3, outpositions, outnormals, outtexcoords, outlmcoords)
+			outlmcoords.append(fv['lmcoord'])
+		numverts += len(fv['position'])
+
+	# Interleaved position, normal, texcoord, lmcoord; patch vertices are float64.
+	if numverts:
+		outvertices = np.hstack([np.concatenate(attr) for attr in (outpositions, outnormals, outtexcoords, outlmcoords)])
+	else:
+		outvertices = np.zeros((0, 3 + 3 + 2 + 2))
+
+	meshkeys = [(mkey, lmkey) for mkey in outindices for lmkey in outindices[mkey]]
+	meshes = splitMeshes([np.concatenate(outindices[mkey][lmkey]) if outindices[mkey][lmkey] else np.zeros(0, np.int64) for mkey, lmkey in meshkeys], outvertices)
+	if optimizeMeshes:
+		optimized = [meshopt.optimize(indices, vertices, weldEpsilon) for indices, vertices in meshes]
+		triangles = __builtin__.float(max(sum(len(indices) for indices, vertices in meshes), 1))
+		print 'ACMR %.3f -> %.3f, %i -> %i vertices' % (
+			sum(before * len(indices) for indices, vertices, before, after in optimized) / triangles, 
+			sum(after * len(indices) for indices, vertices, before, after in optimized) / triangles, 
+			sum(len(vertices) for indices, vertices in meshes), 
+			sum(len(vertices) for indices, vertices, before, after in optimized)
+		)
+		meshes = [(indices, vertices) for indices, vertices, before, after in optimized]
+	meshes = dict(zip(meshkeys, meshes))
+
+	meshnums = dict((key, i) for i, key in enumerate(meshkeys))
+	faceMeshes = np.zeros(len(faces), dtype=np.int64) - 1
+	for face, mkey, lmkey in meshfaces:
+		faceMeshes[face] = meshnums[mkey, lmkey]
+	visibility = clusterVisibility(vis, leafs, leaffaces, faceMeshes, len(meshkeys))
+	del outvertices
 
-	outmeshes = []
 	outmaterials = {}
 	for mkey in outindices:
 		name = textures[mkey].name
@@ -411,23 +661,163 @@ def main(path, mapname):
 			material[0]['Texture'] = '404'
 
 		outmaterials[mkey] = material
+	del outindices
 
-		for lmkey in outindices[mkey]:
-			indices, vertices = splitMesh(outindices[mkey][lmkey], outvertices, 3 + 3 + 2 + 2)
-			outmeshes.append(dict(
-				MaterialIndex=mkey, 
-				LightmapIndex=lmkey, 
-				Indices=indices, 
-				Vertices=vertices
-			))
+	contents = np.array([texture.content_flags for texture in textures], dtype=np.int32)
+	collision = prepareCollision(planes, brushes, brushsides, contents, nodes['plane'])
+	nodes = nodes.copy()
+	nodes['plane'] = collision['PlaneMap'][nodes['plane']]
+	leafs, leafbrushes = remapLeafBrushes(leafs, leafbrushes, collision['BrushMap'])
 
-	tree = btree(0)
+	brushmins, brushmaxs = reminmax(collision['BrushMins'], collision['BrushMaxs'])
 
-	outlm = [adjustBrightness(x.pixels) for x in lightmaps]
+	if outformat == 'binary':
+		entities = dict(Entities=entities, EntityClasses=classnames, EntityOrigins=origins, EntityAngles=angles)
+		entities['LightmapSizes'] = lmSizes.tolist()
+		writeContainer(mapname + '.bin', binaryMeta, entities, outmaterials, [(mkey, lmkey) + meshes[mkey, lmkey] for mkey, lmkey in meshkeys], visibility, lightmaps,
+			collision, brushmins, brushmaxs, flattenTree(nodes, leafs, leafbrushes), quantizeVertices)
+		return
 
-	outfp = file(mapname + '.json', 'wb')
-	outdata = dict(Materials=outmaterials, Meshes=outmeshes, Planes=outplanes, Brushes=outbrushes, Tree=tree, Lightmaps=outlm)
-	json.dump(outdata, outfp)
+	outplanes = []
+	for plane in collision['Planes'].tolist():
+		outplanes.append(dict(Normal=rotate(plane[:3]), Distance=plane[3]))
+	outbrushes = []
+	for sides, mins, maxs in zip(collision['BrushPlanes'], brushmins.tolist(), brushmaxs.tolist()):
+		outbrushes.append(dict(Collidable=True, Planes=sides.tolist(), Mins=mins, Maxs=maxs))
+
+	def btree(ind):
+		if ind >= 0:
+			mins, maxs = reminmax(nodes['mins'][ind], nodes['maxs'][ind])
+			left, right = nodes['children'][ind].tolist()
+			return dict(Leaf=False, Plane=int(nodes['plane'][ind]), Mins=mins.tolist(), Maxs=maxs.tolist(), Left=btree(left), Right=btree(right))
+		else:
+			leaf = leafs[-(ind + 1)]
+			mins, maxs = reminmax(leaf['mins'], leaf['maxs'])
+			return dict(Leaf=True, Plane=-1, Cluster=int(leaf['cluster']), Mins=mins.tolist(), Maxs=maxs.tolist(), Brushes=leafbrushes['brush'][leaf['leafbrush']:leaf['leafbrush']+leaf['n_leafbrushes']].tolist())
+
+	# Meshes and lightmaps are converted to lists one at a time as they are
+	# written, and dropped right after.  Quantized meshes carry their packed
+	# vertices as base64 VertexData, laid out as VertexLayout describes.
+	with atomicFile(mapname + '.json') as outfp:
+		out = JsonStream(outfp)
+		with out.object():
+			out.value(entities, 'Entities')
+			out.value(classnames, 'EntityClasses')
+			out.value(origins, 'EntityOrigins')
+			out.value(angles, 'EntityAngles')
+			out.value(outmaterials, 'Materials')
+			if quantizeVertices:
+				out.value(packVertices(np.zeros((0, 10)))[1], 'VertexLayout')
+			with out.array('Meshes'):
+				for mkey, lmkey in meshkeys:
+					indices, vertices = meshes.pop((mkey, lmkey))
+					mesh = dict(
+						MaterialIndex=mkey, 
+						LightmapIndex=lmkey, 
+						Indices=indices.tolist()
+					)
+					if quantizeVertices:
+						mesh['VertexData'] = quantize.toBase64(packVertices(vertices)[0])
+					else:
+						mesh['Vertices'] = vertices.ravel().tolist()
+					out.value(mesh)
+			out.value(visibility, 'ClusterMeshes')
+			out.value(outplanes, 'Planes')
+			out.value(outbrushes, 'Brushes')
+			if treeFormat == 'flat':
+				tree = flattenTree(nodes, leafs, leafbrushes)
+				out.value(dict((key, value.ravel().tolist()) for key, value in tree.items()), 'FlatTree')
+			else:
+				out.value(btree(0), 'Tree')
+			out.value(lmSizes.tolist(), 'LightmapSizes')
+			with out.array('Lightmaps'):
+				for lightmap in lightmaps:
+					out.value(lightmap.ravel().tolist())
+
+# Writes the map as a container (see container.py) with the same data as the
+# JSON output, but as arrays: meshes share one vertex and one index section,
+# brushes index into one list of plane indices, and the tree is laid out by
+# flattenTree.  Quantized vertices are written as raw bytes, one row per vertex,
+# with a VertexLayout in the metadata.
+def writeContainer(fn, binaryMeta, entities, materials, meshes, visibility, lightmaps, collision, brushmins, brushmaxs, tree, quantizeVertices=False):
+	outmeshes = []
+	firstIndex = firstVertex = 0
+	for mkey, lmkey, indices, vertices in meshes:
+		outmeshes.append(dict(
+			MaterialIndex=mkey, 
+			LightmapIndex=lmkey, 
+			FirstIndex=firstIndex, 
+			IndexCount=len(indices), 
+			FirstVertex=firstVertex, 
+			VertexCount=len(vertices)
+		))
+		firstIndex += len(indices)
+		firstVertex += len(vertices)
+	wideIndices = any(len(vertices) > 0x10000 for mkey, lmkey, indices, vertices in meshes)
+
+	planecounts = np.array([len(sides) for sides in collision['BrushPlanes']], dtype=np.int64)
+	planes = collision['Planes']
+
+	vertices = np.concatenate([vertices for mkey, lmkey, indices, vertices in meshes] or [np.zeros((0, 10))])
+	metadata = dict(entities, Materials=materials, Meshes=outmeshes)
+	if quantizeVertices:
+		vertices, metadata['VertexLayout'] = packVertices(vertices)
+
+	with atomicFile(fn) as fp:
+		writer = ContainerWriter(fp, binaryMeta)
+		writer.section('vertices', vertices, 'u1' if quantizeVertices else 'f4')
+		del vertices
+		writer.section('indices', np.concatenate([indices for mkey, lmkey, indices, vertices in meshes] or [np.zeros(0)]), 'u4' if wideIndices else 'u2')
+		# Texels of each page in turn, sized by LightmapSizes
+		writer.section('lightmaps', np.concatenate([page.reshape(-1, page.shape[-1]) for page in lightmaps] or [np.zeros((0, 3), np.uint8)]), 'u1')
+		# Normal xyz, distance
+		writer.section('planes', np.column_stack((rotate(planes[:, :3]), planes[:, 3])), 'f4')
+		# First brushplane, brushplane count; all brushes are solid
+		writer.section('brushes', np.column_stack((np.cumsum(planecounts) - planecounts, planecounts)), 'i4')
+		writer.section('brushplanes', np.concatenate(collision['BrushPlanes'] or [np.zeros(0)]), 'i4')
+		# Mins, maxs
+		writer.section('brushbounds', np.column_stack((brushmins, brushmaxs)), 'f4')
+		# Plane, children (negative for leaf -(i + 1)), mins, maxs
+		writer.section('nodes', np.column_stack((tree['NodePlanes'], tree['NodeChildren'], tree['NodeMins'], tree['NodeMaxs'])), 'i4')
+		# Mins, maxs, first leafbrush, leafbrush count, cluster
+		writer.section('leafs', np.column_stack((tree['LeafMins'], tree['LeafMaxs'], tree['LeafFirstBrush'], tree['LeafBrushCount'], tree['LeafClusters'])), 'i4')
+		writer.section('leafbrushes', tree['LeafBrushes'], 'i4')
+		# Runs of visible meshes (first mesh, mesh count), then each cluster's
+		# range of runs (first run, run count)
+		runCounts = np.array([len(runs) / 2 for runs in visibility], dtype=np.int64)
+		writer.section('visruns', np.concatenate([np.asarray(runs, np.int64) for runs in visibility] or [np.zeros(0, np.int64)]).reshape(-1, 2), 'i4')
+		writer.section('clusters', np.column_stack((np.cumsum(runCounts) - runCounts, runCounts)), 'i4')
+		writer.close(metadata)
+
+def cli():
+	parser = argparse.ArgumentParser(description='Convert a Quake 3 BSP to WebArena JSON.')
+	parser.add_argument('path', help='asset directory')
+	parser.add_argument('mapname')
+	parser.add_argument('--tess-error', dest='tessError', type=__builtin__.float, help='adapt patch tessellation to keep curves within this many units (default: fixed level 5)')
+	parser.add_argument('--tess-edge', dest='tessEdge', type=__builtin__.float, help='adapt patch tessellation to keep segments no longer than this many units; combines with --tess-error')
+	parser.add_argument('--tess-min', dest='tessMin', type=int, default=1, help='minimum adaptive tessellation level')
+	parser.add_argument('--tess-max', dest='tessMax', type=int, default=8, help='maximum adaptive tessellation level')
+	parser.add_argument('--lm-shift', dest='lmShift', type=int, default=2, help='overbright bits to shift lightmaps by (default: 2)')
+	parser.add_argument('--lm-gamma', dest='lmGamma', type=__builtin__.float, default=1., help='gamma applied to lightmaps (default: 1.0)')
+	parser.add_argument('--format', dest='outformat', choices=('json', 'binary'), default='json', help='write <mapname>.json, or a binary container to <mapname>.bin')
+	parser.add_argument('--binary-meta', dest='binaryMeta', action='store_true', help='encode binary container metadata without JSON')
+	parser.add_argument('--lm-atlas', dest='lmAtlas', type=int, metavar='SIZE', help='pack lightmaps into atlas pages of up to SIZE texels square, so meshes split only by page')
+	parser.add_argument('--optimize', dest='optimizeMeshes', action='store_true', help='weld duplicate vertices and reorder triangles and vertices for the GPU vertex cache')
+	parser.add_argument('--weld-epsilon', dest='weldEpsilon', type=__builtin__.float, default=0., help='with --optimize, weld vertices into earlier ones that every attribute is within this of (default: exact matches only)')
+	parser.add_argument('--quantize', dest='quantizeVertices', action='store_true', help='pack vertices with octahedral normals and 16 bit lightmap coordinates, described by VertexLayout')
+	parser.add_argument('--tree', dest='treeFormat', choices=('nested', 'flat'), default='nested', help='write the BSP tree as nested Tree objects, or as FlatTree arrays')
+	args = parser.parse_args()
+	if args.tessError is not None and args.tessError <= 0 or args.tessEdge is not None and args.tessEdge <= 0:
+		parser.error('--tess-error and --tess-edge must be positive')
+	if not 1 <= args.tessMin <= args.tessMax:
+		parser.error('--tess-min must be at least 1 and no more than --tess-max')
+	if args.lmShift < 0 or args.lmGamma <= 0:
+		parser.error('--lm-shift must not be negative and --lm-gamma must be positive')
+	if args.weldEpsilon < 0:
+		parser.error('--weld-epsilon must not be negative')
+	if args.lmAtlas is not None and args.lmAtlas < 130:
+		parser.error('--lm-atlas must be at least 130, a 128 texel lightmap and its padding')
+	main(**vars(args))
 
 if __name__=='__main__':
-	main(*sys.argv[1:])
+	cli()
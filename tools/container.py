@@ -0,0 +1,172 @@
+import __builtin__, json, struct
+import numpy as np
+from Struct import *
+
+# Binary container for converted assets.  Layout, all little-endian:
+#
+#   ContainerHeader
+#   sections, each starting on an `alignment` byte boundary
+#   metadata, JSON text or the tagged encoding below
+#   SectionEntry table
+#
+# Sections are flat arrays of `count` rows of `width` elements of `type`
+# (numpy typestr without the byte order: f4, u1, u2, u4, i4), so a client can
+# wrap them in typed arrays as they are.  Sections are written as they come,
+# and the header is filled in last.
+
+MAGIC = 'WACF'
+VERSION = 1
+FLAG_BINARY_META = 1
+alignment = 16
+
+@Struct
+def ContainerHeader():
+	magic = string(4)
+	version = uint32
+	flags = uint32
+	meta_offset, meta_length = uint32[2]
+	table_offset, n_sections = uint32[2]
+
+@Struct
+def SectionEntry():
+	name = string(16)
+	type = string(4)
+	width = uint32
+	count = uint32
+	offset = uint32
+
+class ContainerException(Exception):
+	pass
+
+# Tagged binary encoding of JSON-style values, for when the metadata should not
+# need a JSON parser.
+def encodeMeta(value, out=None):
+	if out is None:
+		out = []
+		encodeMeta(value, out)
+		return ''.join(out)
+
+	if value is None:
+		out.append('N')
+	elif value is True or value is False:
+		out.append('T' if value else 'F')
+	elif isinstance(value, (int, long)):
+		out.append(struct.pack('<cq', 'i', value))
+	elif isinstance(value, __builtin__.float):
+		out.append(struct.pack('<cd', 'd', value))
+	elif isinstance(value, basestring):
+		if isinstance(value, unicode):
+			value = value.encode('utf-8')
+		out.append(struct.pack('<cI', 's', len(value)) + value)
+	elif isinstance(value, (list, tuple)):
+		out.append(struct.pack('<cI', 'l', len(value)))
+		for elem in value:
+			encodeMeta(elem, out)
+	elif isinstance(value, dict):
+		out.append(struct.pack('<cI', 'm', len(value)))
+		for key, elem in value.items():
+			encodeMeta(unicode(key), out)
+			encodeMeta(elem, out)
+	else:
+		raise ContainerException('Cannot encode %r' % (value, ))
+
+def decodeMeta(data, pos=0, top=True):
+	tag = data[pos]
+	pos += 1
+	if tag == 'N':
+		value = None
+	elif tag in 'TF':
+		value = tag == 'T'
+	elif tag == 'i':
+		value, = struct.unpack_from('<q', data, pos)
+		pos += 8
+	elif tag == 'd':
+		value, = struct.unpack_from('<d', data, pos)
+		pos += 8
+	elif tag == 's':
+		size, = struct.unpack_from('<I', data, pos)
+		value = data[pos + 4:pos + 4 + size].decode('utf-8')
+		pos += 4 + size
+	elif tag in 'lm':
+		count, = struct.unpack_from('<I', data, pos)
+		pos += 4
+		value = [] if tag == 'l' else {}
+		for i in xrange(count):
+			if tag == 'l':
+				elem, pos = decodeMeta(data, pos, False)
+				value.append(elem)
+			else:
+				key, pos = decodeMeta(data, pos, False)
+				value[key], pos = decodeMeta(data, pos, False)
+	else:
+		raise ContainerException('Bad metadata tag %r at %i' % (tag, pos - 1))
+	return value if top else (value, pos)
+
+class ContainerWriter(object):
+	def __init__(self, fp, binaryMeta=False):
+		self.fp = fp
+		self.binaryMeta = binaryMeta
+		self.entries = []
+		self.pos = len(ContainerHeader())
+		self.fp.write('\0' * self.pos)
+
+	def pad(self):
+		padding = -self.pos % alignment
+		self.fp.write('\0' * padding)
+		self.pos += padding
+
+	# Writes data, any array-like of at most two dimensions, as the given type.
+	def section(self, name, data, type):
+		if len(name) > 16:
+			raise ContainerException('Section name too long: %s' % name)
+		data = np.ascontiguousarray(data, dtype='<' + type)
+		if data.ndim > 2:
+			raise ContainerException('Section %s has %i dimensions' % (name, data.ndim))
+		count = len(data) if data.ndim else 1
+		width = data.shape[1] if data.ndim == 2 else 1
+
+		self.pad()
+		self.entries.append(SectionEntry(name=name, type=type, width=width, count=count, offset=self.pos))
+		self.fp.write(data.tostring())
+		self.pos += data.nbytes
+
+	def close(self, metadata):
+		if self.binaryMeta:
+			meta = encodeMeta(metadata)
+		else:
+			meta = json.dumps(metadata)
+		self.pad()
+		header = ContainerHeader(
+			magic=MAGIC,
+			version=VERSION,
+			flags=FLAG_BINARY_META if self.binaryMeta else 0,
+			meta_offset=self.pos,
+			meta_length=len(meta)
+		)
+		self.fp.write(meta)
+		self.pos += len(meta)
+
+		self.pad()
+		header.table_offset = self.pos
+		header.n_sections = len(self.entries)
+		self.fp.write(str(SectionEntry.packArray(self.entries)))
+		self.fp.seek(0)
+		self.fp.write(str(header.pack()))
+
+# Returns the metadata and a dict of sections as (count, width) arrays.  Given a
+# str or mmap, the arrays share its memory.
+def readContainer(data):
+	header = ContainerHeader(unpack=data)
+	if header.magic != MAGIC:
+		raise ContainerException('Not a container: magic %r' % header.magic)
+	if header.version != VERSION:
+		raise ContainerException('Unsupported container version %i' % header.version)
+
+	meta = data[header.meta_offset:header.meta_offset + header.meta_length]
+	metadata = decodeMeta(meta) if header.flags & FLAG_BINARY_META else json.loads(meta)
+
+	sections = {}
+	for entry in SectionEntry.unpackLazy(data, header.n_sections, header.table_offset):
+		array = np.frombuffer(data, dtype='<' + entry.type, count=entry.count * entry.width, offset=entry.offset)
+		sections[entry.name] = array.reshape(entry.count, entry.width)
+	return metadata, sections
@@ -0,0 +1,50 @@
+import numpy as np
+
+# Helpers for raw pixel buffers (lightmaps, textures).  Images are numpy arrays
+# shaped (..., height, width, channels); everything here is a view of the
+# input where numpy allows it, and a single linear pass otherwise.
+
+# Wraps a flat buffer (str, bytearray, mmap, array.array, ndarray) without
+# copying it.  With a count, the buffer holds that many images (-1 for as many
+# as fit) and they come back along a leading axis.
+def view(data, width, height, channels=3, count=None):
+	if not isinstance(data, np.ndarray):
+		data = np.frombuffer(data, dtype=np.uint8)
+	if count is None:
+		return data.reshape(height, width, channels)
+	return data.reshape(count, height, width, channels)
+
+# Reverses the row order.  Flat buffers, of any type view accepts, need the row
+# size in elements.
+def flipRows(image, stride=None):
+	if stride is not None:
+		if not isinstance(image, np.ndarray):
+			image = np.frombuffer(image, dtype=np.uint8)
+		return image.reshape(-1, stride)[::-1].ravel()
+	return image[..., ::-1, :, :]
+
+# Reorders channels, by default swapping RGB and BGR and keeping alpha in place.
+# Grey and grey-alpha images are left as they are.
+def swapChannels(image, order=None):
+	if order is None:
+		order = ((0, ), (0, 1), (2, 1, 0), (2, 1, 0, 3))[image.shape[-1] - 1]
+	return image[..., order]
+
+# Grey and grey-alpha images are expanded to RGB, keeping their alpha in toRGBA.
+def toRGB(image):
+	if image.shape[-1] < 3:
+		return np.repeat(image[..., :1], 3, axis=-1)
+	return image[..., :3]
+
+def toRGBA(image, alpha=255):
+	channels = image.shape[-1]
+	if channels == 4:
+		return image
+	out = np.empty(image.shape[:-1] + (4, ), dtype=image.dtype)
+	out[..., :3] = toRGB(image)
+	out[..., 3] = image[..., 1] if channels == 2 else alpha
+	return out
+
+# Contiguous bytes of an image, e.g. for writing it out or handing it to PIL.
+def toBytes(image):
+	return np.ascontiguousarray(image).tostring()
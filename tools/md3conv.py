@@ -1,6 +1,9 @@
 import math, sys
+import numpy as np
 from pprint import pprint
 from Struct import *
+from outfile import atomicFile, JsonStream
+import quantize
 
 @Struct
 def Frame():
@@ -41,15 +44,11 @@ def Surface(self):
 	num_frames, num_shaders, num_verts, num_triangles = uint32[4].ignore
 	ofs_triangles, ofs_shaders, ofs_st, ofs_xyznormal, ofs_end = uint32[5].ignore
 
-	with struct_seek(self.ofs_shaders, STRUCT_RELATIVE):
-		shaders = Shader()[self.num_shaders]
-	with struct_seek(self.ofs_triangles, STRUCT_RELATIVE):
-		triangles = Triangle()[self.num_triangles]
-	with struct_seek(self.ofs_st, STRUCT_RELATIVE):
-		texcoords = TexCoord()[self.num_verts]
-	with struct_seek(self.ofs_xyznormal, STRUCT_RELATIVE):
-		vertices = Vertex()[lambda self: self.num_frames * self.num_verts]
-	struct_seek(self.ofs_end, STRUCT_RELATIVE)
+	shaders = Shader()[self.num_shaders].at(self.ofs_shaders)
+	triangles = Triangle()[self.num_triangles].at(self.ofs_triangles)
+	texcoords = TexCoord()[self.num_verts].at(self.ofs_st)
+	vertices = Vertex()[lambda self: self.num_frames * self.num_verts].at(self.ofs_xyznormal)
+	struct_size(self.ofs_end)
 
 @Struct
 def Header(self):
@@ -60,13 +59,10 @@ def Header(self):
 	num_frames, num_tags, num_surfaces, num_skins = uint32[4].ignore
 	ofs_frames, ofs_tags, ofs_surfaces, ofs_eof = uint32[4].ignore
 
-	with struct_seek(self.ofs_frames, STRUCT_RELATIVE):
-		frames = Frame()[self.num_frames]
-	with struct_seek(self.ofs_tags, STRUCT_RELATIVE):
-		tags = Tag()[lambda self: self.num_frames * self.num_tags]
-	with struct_seek(self.ofs_surfaces, STRUCT_RELATIVE):
-		surfaces = Surface()[self.num_surfaces]
-	struct_seek(self.ofs_eof, STRUCT_RELATIVE)
+	frames = Frame()[self.num_frames].at(self.ofs_frames)
+	tags = Tag()[lambda self: self.num_frames * self.num_tags].at(self.ofs_tags)
+	surfaces = Surface()[self.num_surfaces].at(self.ofs_surfaces)
+	struct_size(self.ofs_eof)
 
 def rewind(data, xmod=-1):
 	out = []
@@ -95,9 +91,7 @@ def mat2quat(mat):
 		s = 2 * math.sqrt(1 + m33 - m11 - m22)
 		return (m13 + m31) / s, (m23 + m32) / s, 0.25 * s, (m21 - m12) / s
 
-def convert(inp):
-	data = Header(inp)
-
+def convertTags(data):
 	tags = {}
 	for i in xrange(data.num_tags):
 		name = data.tags[i].name
@@ -109,8 +103,37 @@ def convert(inp):
 			#this.append(dict(Position=tag.origin, Rotation=mat2quat(tag.axis)))
 		tags[name] = this
 	#pprint(tags)
-
-	meshes = []
+	return tags
+
+# Packs a frame's int16 coordinates, unscaled, and octahedral normals.
+def packFrame(coords, normals):
+	return quantize.interleave([
+		('Position', coords.astype(np.int16), False, dict(Encoding='scaled', Scale=1 / 64.)), 
+		('Normal', quantize.octEncode(normals), True, dict(Encoding='octahedral')), 
+	])
+
+# Quantized counterpart to the loops in convertMeshes: frames and texcoords are
+# base64 buffers laid out as FrameLayout and TexcoordLayout describe.
+def packMesh(this, surface, num_frames):
+	vertices = surface.vertices
+	count = len(surface.texcoords)
+	coords = np.array([vert.coord for vert in vertices], dtype=np.int32).reshape(num_frames, count, 3)
+	coords = np.clip(np.stack((-coords[..., 0], coords[..., 2], coords[..., 1]), axis=-1), -32768, 32767)
+	angles = np.array([vert.normal for vert in vertices], dtype=np.float64).reshape(num_frames, count, 2) * 2 * math.pi / 255.
+	lat, long = angles[..., 0], angles[..., 1]
+	normals = np.stack((-np.cos(long) * np.sin(lat), np.cos(lat), np.sin(long) * np.sin(lat)), axis=-1)
+
+	for i in xrange(num_frames):
+		frame, this['FrameLayout'] = packFrame(coords[i], normals[i])
+		this['Frames'].append(quantize.toBase64(frame))
+	texcoords, encoding = quantize.unorm16Range(np.array([texcoord.st for texcoord in surface.texcoords], dtype=np.float64).reshape(-1, 2))
+	texcoords, this['TexcoordLayout'] = quantize.interleave([('Texcoord', texcoords, True, encoding)])
+	this['Texcoords'] = quantize.toBase64(texcoords)
+	if not num_frames:
+		this['FrameLayout'] = packFrame(np.zeros((0, 3)), np.zeros((0, 3)))[1]
+
+# Yields one mesh per surface, so callers can write each out before the next.
+def convertMeshes(data, packed=False):
 	for surface in data.surfaces:
 		print `surface.name`
 		this = dict(
@@ -119,7 +142,13 @@ def convert(inp):
 			Texcoords=[], 
 			Indices=[]
 		)
-		meshes.append(this)
+		for triangle in surface.triangles:
+			this['Indices'] += rewind(triangle.indices, 1)
+		if packed:
+			packMesh(this, surface, data.num_frames)
+			yield this
+			continue
+
 		for texcoord in surface.texcoords:
 			this['Texcoords'] += texcoord.st
 
@@ -140,23 +169,38 @@ def convert(inp):
 				#normals += vert.normal
 			this['Frames'].append(vertices)
 
-		for triangle in surface.triangles:
-			this['Indices'] += rewind(triangle.indices, 1)
+		yield this
 
+def convert(inp, packed=False):
+	data = Header(inp)
 	return dict(
-		RawTags=tags, 
-		Meshes=meshes, 
+		RawTags=convertTags(data), 
+		Meshes=list(convertMeshes(data, packed)), 
 	)
 
-def main(fn, ofn=None):
+# Streams the converted model into out, a JsonStream, a mesh at a time.
+def writeModel(out, inp, key=None, packed=False):
+	data = Header(inp)
+	with out.object(key):
+		out.value(convertTags(data), 'RawTags')
+		with out.array('Meshes'):
+			for mesh in convertMeshes(data, packed):
+				out.value(mesh)
+
+# outformat is 'json', or 'quantized' for packed vertex buffers.
+def main(fn, ofn=None, outformat='json'):
 	fp = file(fn, 'rb')
 	#header = Header(fp)
 	
-	data = convert(fp)
-	if ofn is not None:
+	if ofn is None:
+		convert(fp)
+	else:
 		import json
-		json.encoder.FLOAT_REPR = lambda o: format(o, '.4f')
-		json.dump(data, file(ofn, 'wb'))
+		# Quantized output keeps full precision for the few floats it has left.
+		if outformat != 'quantized':
+			json.encoder.FLOAT_REPR = lambda o: format(o, '.4f')
+		with atomicFile(ofn) as outfp:
+			writeModel(JsonStream(outfp), fp, packed=outformat == 'quantized')
 
 if __name__=='__main__':
 	main(*sys.argv[1:])
@@ -0,0 +1,144 @@
+import itertools
+import numpy as np
+
+# Index and vertex buffer optimizations for triangle lists.  Meshes are an index
+# array (3 per triangle) and an (n, k) vertex array of interleaved attributes.
+
+# Merges vertices whose attributes all match, exactly or, with an epsilon, to
+# within it: each vertex joins the earliest kept vertex that it differs from by
+# less than epsilon in every attribute, or is kept itself.
+def weld(indices, vertices, epsilon=0):
+	# Adding 0 turns -0.0 into 0.0, so those weld too.
+	keys = np.ascontiguousarray(vertices + 0., dtype=np.float64)
+	keys = keys.view(np.dtype((np.void, keys.itemsize * keys.shape[1]))).ravel()
+	keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+	target = first[inverse]
+	if epsilon:
+		target = nearTargets(vertices, np.sort(first), epsilon)[target]
+	kept = np.unique(target)
+	return np.searchsorted(kept, target)[indices], vertices[kept]
+
+# Maps each of the candidate vertices, in index order, to the earliest before it
+# within epsilon in every attribute, or to itself.  Kept vertices are hashed
+# into epsilon sized cells by their first three attributes (the position), and
+# the neighbouring cells are searched too, so matches across cell boundaries
+# are found.
+def nearTargets(vertices, candidates, epsilon):
+	out = np.arange(len(vertices))
+	rows = vertices.tolist()
+	cells = np.floor(vertices[:, :3] / epsilon).astype(np.int64).tolist()
+	offsets = list(itertools.product((-1, 0, 1), repeat=min(vertices.shape[1], 3)))
+	buckets = {}
+	for i in candidates.tolist():
+		row, cell = rows[i], cells[i]
+		match = -1
+		for offset in offsets:
+			for j in buckets.get(tuple(c + o for c, o in zip(cell, offset)), ()):
+				if (match < 0 or j < match) and max(abs(a - b) for a, b in zip(row, rows[j])) < epsilon:
+					match = j
+		if match < 0:
+			buckets.setdefault(tuple(cell), []).append(i)
+		else:
+			out[i] = match
+	return out
+
+# Average cache miss ratio: vertex shader runs per triangle through a FIFO
+# post-transform cache of the given size.  0.5 is the ideal for large meshes, 3
+# the worst case.
+def acmr(indices, cacheSize=32):
+	if not len(indices):
+		return 0.
+	cache = []
+	cached = set()
+	misses = 0
+	for index in indices.tolist():
+		if index not in cached:
+			misses += 1
+			cache.append(index)
+			cached.add(index)
+			if len(cache) > cacheSize:
+				cached.discard(cache.pop(0))
+	return misses * 3. / len(indices)
+
+def vertexScore(cachePos, remaining, cacheSize):
+	if not remaining:
+		return -1.
+	score = 0.
+	if cachePos >= 0:
+		if cachePos < 3:
+			score = .75
+		else:
+			score = (1. - (cachePos - 3) / float(cacheSize - 3)) ** 1.5
+	return score + 2. * remaining ** -.5
+
+# Reorders triangles for post-transform cache locality, following Tom Forsyth's
+# "Linear-Speed Vertex Cache Optimisation": greedily emit the best scoring
+# triangle touching an LRU-modelled cache, where vertices score for being
+# recently used and for having few triangles left.
+def forsyth(indices, vertexCount, cacheSize=32):
+	tris = indices.reshape(-1, 3).tolist()
+	vertTris = [[] for i in xrange(vertexCount)]
+	for i, tri in enumerate(tris):
+		for index in tri:
+			vertTris[index].append(i)
+	cachePos = [-1] * vertexCount
+	vscore = [vertexScore(-1, len(x), cacheSize) for x in vertTris]
+	tscore = [vscore[a] + vscore[b] + vscore[c] for a, b, c in tris]
+	emitted = [False] * len(tris)
+
+	out = []
+	cache = []
+	nextTri = 0
+	best = max(xrange(len(tris)), key=tscore.__getitem__) if tris else -1
+	while best >= 0:
+		emitted[best] = True
+		out.append(best)
+		tri = tris[best]
+		for index in tri:
+			vertTris[index].remove(best)
+
+		used = []
+		for index in tri:
+			if index not in used:
+				used.append(index)
+		cache = used + [index for index in cache if index not in used]
+		evicted = cache[cacheSize:]
+		del cache[cacheSize:]
+		for index in evicted:
+			cachePos[index] = -1
+			vscore[index] = vertexScore(-1, len(vertTris[index]), cacheSize)
+		for i, index in enumerate(cache):
+			cachePos[index] = i
+			vscore[index] = vertexScore(i, len(vertTris[index]), cacheSize)
+
+		best, bestScore = -1, -1.
+		for index in cache + evicted:
+			for i in vertTris[index]:
+				a, b, c = tris[i]
+				tscore[i] = score = vscore[a] + vscore[b] + vscore[c]
+				if score > bestScore:
+					best, bestScore = i, score
+		if best < 0:
+			while nextTri < len(tris) and emitted[nextTri]:
+				nextTri += 1
+			best = nextTri if nextTri < len(tris) else -1
+
+	return indices.reshape(-1, 3)[np.array(out, dtype=np.int64)].ravel() if out else indices
+
+# Renumbers vertices in order of first use, so vertex fetches walk the buffer
+# forward.  Unreferenced vertices are dropped.
+def reorderVertices(indices, vertices):
+	order, first = np.unique(indices, return_index=True)
+	order = order[np.argsort(first)]
+	remap = np.zeros(len(vertices), dtype=np.int64) - 1
+	remap[order] = np.arange(len(order))
+	return remap[indices], vertices[order]
+
+# Welds, reorders triangles, then reorders vertices.  Returns the new indices
+# and vertices, along with the ACMR before and after.
+def optimize(indices, vertices, epsilon=0, cacheSize=32):
+	before = acmr(indices, cacheSize)
+	indices, vertices = weld(indices, vertices, epsilon)
+	indices = forsyth(indices, len(vertices), cacheSize)
+	indices, vertices = reorderVertices(indices, vertices)
+	return indices, vertices, before, acmr(indices, cacheSize)
@@ -0,0 +1,75 @@
+import json, os
+from contextlib import contextmanager
+
+# Output helpers for the converters.  atomicFile writes to a temporary file
+# beside the target and only moves it into place once everything was written,
+# so a failed or interrupted conversion never leaves a truncated file behind.
+# JsonStream writes a JSON document a piece at a time, so large sections can be
+# written as they are produced and freed afterwards.
+
+class OutputException(Exception):
+	pass
+
+@contextmanager
+def atomicFile(fn):
+	tmpfn = fn + '.tmp'
+	fp = file(tmpfn, 'wb')
+	try:
+		yield fp
+		fp.flush()
+		os.fsync(fp.fileno())
+		fp.close()
+		if os.name == 'nt' and os.path.exists(fn):
+			os.remove(fn)
+		os.rename(tmpfn, fn)
+	except:
+		fp.close()
+		if os.path.exists(tmpfn):
+			os.remove(tmpfn)
+		raise
+
+# with out.object(): out.value(1, 'a'); with out.array('b'): out.value(2)
+# writes {"a": 1, "b": [2]}.  Keys are only given inside objects.
+class JsonStream(object):
+	def __init__(self, fp, **dumpArgs):
+		self.fp = fp
+		self.dumpArgs = dumpArgs
+		self.stack = []
+		self.done = False
+
+	def prefix(self, key):
+		if not self.stack:
+			if self.done:
+				raise OutputException('Only one top-level value can be written')
+			self.done = True
+			return
+
+		top = self.stack[-1]
+		if top[1]:
+			self.fp.write(', ')
+		top[1] += 1
+		if top[0] == '{':
+			if key is None:
+				raise OutputException('Object members need a key')
+			self.fp.write(json.dumps(key if isinstance(key, basestring) else str(key)) + ': ')
+		elif key is not None:
+			raise OutputException('Array elements cannot have a key')
+
+	def value(self, value, key=None):
+		self.prefix(key)
+		json.dump(value, self.fp, **self.dumpArgs)
+
+	@contextmanager
+	def container(self, key, start, end):
+		self.prefix(key)
+		self.fp.write(start)
+		self.stack.append([start, 0])
+		yield self
+		self.stack.pop()
+		self.fp.write(end)
+
+	def object(self, key=None):
+		return self.container(key, '{', '}')
+
+	def array(self, key=None):
+		return self.container(key, '[', ']')
@@ -1,7 +1,8 @@
 import json, re, sys
 from glob import glob
 from pprint import pprint
-from md3conv import convert, Header
+from md3conv import convert, writeModel, Header
+from outfile import atomicFile, JsonStream
 
 def loadSkin(fn):
 	data = file(fn, 'r').read()
@@ -73,22 +74,31 @@ def loadAnimations(dir):
 
 	return sex, animations
 
-def main(dir, ofn=None):
+# outformat is 'json', or 'quantized' for packed vertex buffers (see md3conv).
+def main(dir, ofn=None, outformat='json'):
 	skins = loadAllSkins(dir)
 	sex, animations = loadAnimations(dir)
 
-	output = dict(
-		sex=sex, 
-		animations=animations, 
-		lower=processFile(dir + '/lower.md3'), 
-		upper=processFile(dir + '/upper.md3'), 
-		head=processFile(dir + '/head.md3'), 
-		skins=skins
-	)
 	if ofn is None:
-		pprint(output)
-	else:
-		json.dump(output, file(ofn, 'wb'))
+		pprint(dict(
+			sex=sex, 
+			animations=animations, 
+			lower=processFile(dir + '/lower.md3'), 
+			upper=processFile(dir + '/upper.md3'), 
+			head=processFile(dir + '/head.md3'), 
+			skins=skins
+		))
+		return
+
+	# Each model is converted and written before the next is loaded.
+	with atomicFile(ofn) as outfp:
+		out = JsonStream(outfp)
+		with out.object():
+			out.value(sex, 'sex')
+			out.value(animations, 'animations')
+			for part in ('lower', 'upper', 'head'):
+				writeModel(out, file('%s/%s.md3' % (dir, part), 'rb'), part, outformat == 'quantized')
+			out.value(skins, 'skins')
 
 if __name__=='__main__':
 	main(*sys.argv[1:])
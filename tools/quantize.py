@@ -0,0 +1,82 @@
+import base64
+import numpy as np
+
+# Quantized vertex attributes.  Attributes are packed into one interleaved byte
+# buffer, described by a layout the client can hand straight to
+# vertexAttribPointer:
+#
+#   {"Stride": 24, "Attributes": [{"Name": "Normal", "Size": 2, "Type": "SHORT",
+#     "Normalized": true, "Offset": 12, "Encoding": "octahedral"}, ...]}
+#
+# Type is the GL type name.  Encoding is absent for attributes that are usable
+# as read, "octahedral" for unit vectors folded into two components (see
+# octDecode), and "scaled" for values to be multiplied by Scale and then, if
+# given, offset by Bias (either a number or one per component).
+
+glTypes = {
+	'f4' : 'FLOAT',
+	'i2' : 'SHORT',
+	'u2' : 'UNSIGNED_SHORT',
+	'i1' : 'BYTE',
+	'u1' : 'UNSIGNED_BYTE',
+}
+
+def snorm16(values):
+	return np.round(np.clip(values, -1, 1) * 32767).astype(np.int16)
+
+def unorm16(values):
+	return np.round(np.clip(values, 0, 1) * 65535).astype(np.uint16)
+
+# Stores each column of values as unorm16 over its own range.  Returns the
+# packed values and the descriptor keys that map them back.
+def unorm16Range(values):
+	if not len(values):
+		return unorm16(values), dict(Encoding='scaled', Scale=[0.] * values.shape[1], Bias=[0.] * values.shape[1])
+	lo, hi = values.min(axis=0), values.max(axis=0)
+	scale = hi - lo
+	packed = unorm16((values - lo) / np.where(scale > 0, scale, 1))
+	return packed, dict(Encoding='scaled', Scale=scale.tolist(), Bias=lo.tolist())
+
+def octFold(p):
+	return (1 - np.abs(p[..., ::-1])) * np.where(p >= 0, 1., -1.)
+
+# Projects unit vectors onto the octahedron |x| + |y| + |z| = 1 and unfolds the
+# lower half over the corners of the upper one, giving two snorm16 components.
+def octEncode(normals):
+	normals = np.asarray(normals, dtype=np.float64)
+	lengths = np.abs(normals).sum(axis=-1)[..., np.newaxis]
+	p = normals[..., :2] / np.where(lengths > 0, lengths, 1)
+	return snorm16(np.where(normals[..., 2:] < 0, octFold(p), p))
+
+def octDecode(packed):
+	p = np.maximum(packed / 32767., -1)
+	z = 1 - np.abs(p).sum(axis=-1)[..., np.newaxis]
+	v = np.concatenate((np.where(z < 0, octFold(p), p), z), axis=-1)
+	return v / np.linalg.norm(v, axis=-1)[..., np.newaxis]
+
+# Interleaves attributes, given as (name, (n, size) array, normalized, extra
+# descriptor keys), into an (n, stride) uint8 array.  Each attribute starts on
+# a 4 byte boundary.  Returns the array and its layout.
+def interleave(attributes):
+	count = len(attributes[0][1])
+	parts = []
+	layout = []
+	offset = 0
+	for name, values, normalized, extra in attributes:
+		values = np.asarray(values)
+		width = values.shape[1] * values.dtype.itemsize
+		data = np.ascontiguousarray(values, dtype=values.dtype.newbyteorder('<')).view(np.uint8).reshape(count, width)
+		attribute = dict(Name=name, Size=values.shape[1], Type=glTypes[values.dtype.str[1:]], Normalized=normalized, Offset=offset)
+		attribute.update(extra)
+		layout.append(attribute)
+		parts.append((offset, data))
+		offset += -(-width // 4) * 4
+
+	out = np.zeros((count, offset), dtype=np.uint8)
+	for start, data in parts:
+		out[:, start:start + data.shape[1]] = data
+	return out, dict(Stride=offset, Attributes=layout)
+
+# For JSON output.
+def toBase64(data):
+	return base64.b64encode(np.ascontiguousarray(data).tostring())
@@ -0,0 +1,174 @@
+import json, os, platform, random, struct, sys, tempfile, timeit
+import Struct, bspconv, md3conv
+
+# Offline throughput benchmarks for Struct.py.  Buffers are synthesized for the
+# real bspconv/md3conv definitions, so no Quake assets are needed.  Results are
+# printed (or written to the given file) as JSON so runs can be diffed.
+#
+#   python structbench.py [output.json] [min seconds per case]
+
+def randomBytes(size):
+	return ''.join(chr(random.randint(0, 255)) for i in xrange(size))
+
+def vertexData(count):
+	return ''.join(struct.pack('<10f4B', *([random.uniform(-4096, 4096) for j in xrange(10)] + [random.randint(0, 255) for j in xrange(4)])) for i in xrange(count))
+
+def faceData(count):
+	return ''.join(struct.pack('<12i12f2i', *([random.randint(0, 1000) for j in xrange(12)] + [random.uniform(-1, 1) for j in xrange(12)] + [3, 3])) for i in xrange(count))
+
+def surfaceData(frames, verts, triangles, shaders):
+	header = 4 + 64 + 4 + 16 + 20
+	shaderData = ''.join(struct.pack('<64sI', 'shader%i' % i, i) for i in xrange(shaders))
+	triangleData = ''.join(struct.pack('<3i', *[random.randint(0, verts - 1) for j in xrange(3)]) for i in xrange(triangles))
+	texcoordData = ''.join(struct.pack('<2f', random.random(), random.random()) for i in xrange(verts))
+	vertexData = ''.join(struct.pack('<3h2B', *([random.randint(-4096, 4096) for j in xrange(3)] + [random.randint(0, 255) for j in xrange(2)])) for i in xrange(frames * verts))
+
+	ofs_shaders = header
+	ofs_triangles = ofs_shaders + len(shaderData)
+	ofs_st = ofs_triangles + len(triangleData)
+	ofs_xyznormal = ofs_st + len(texcoordData)
+	ofs_end = ofs_xyznormal + len(vertexData)
+	return struct.pack('<4s64si4I5I', 'IDP3', 'surface', 0, frames, shaders, verts, triangles, ofs_triangles, ofs_shaders, ofs_st, ofs_xyznormal, ofs_end) + shaderData + triangleData + texcoordData + vertexData
+
+# Returns the best time for a single call, timing batches of calls long enough
+# to be well above the timer resolution.
+def measure(func, minTime):
+	timer = timeit.Timer(func)
+	number = 1
+	while timer.timeit(number) < minTime / 20:
+		number *= 2
+	samples = []
+	while sum(samples) < minTime or len(samples) < 3:
+		samples.append(timer.timeit(number))
+	return min(samples) / number, len(samples) * number
+
+def setCodecs(enabled):
+	Struct.useCodecs = enabled
+	for module in (bspconv, md3conv):
+		for value in vars(module).values():
+			if isinstance(value, type) and issubclass(value, Struct.BaseStruct):
+				value.__getlayout__().decode = None
+
+def cases(tmpdir):
+	vertices = vertexData(20000)
+	faces = faceData(10000)
+	lightmaps = randomBytes(128 * 128 * 3 * 8)
+	surface = surfaceData(10, 200, 300, 2)
+	surfaces = surface * 20
+
+	vertexFile = os.path.join(tmpdir, 'vertices.bin')
+	with file(vertexFile, 'wb') as fp:
+		fp.write(vertices)
+
+	def single(cls, data, count):
+		size = len(data) / count
+		def run():
+			for i in xrange(count):
+				cls(unpack=(data, i * size))
+		return run
+
+	def fromFile(cls, path, count):
+		def run():
+			with file(path, 'rb') as fp:
+				for i in xrange(count):
+					cls(unpack=fp)
+		return run
+
+	def lazy(cls, data):
+		def run():
+			for record in cls.unpackLazy(data):
+				pass
+		return run
+
+	# unpackArray only creates a view, so copy it out to measure a real decode.
+	def numpyArray(cls, data):
+		return lambda: cls.unpackArray(data).copy()
+
+	def surfaceFull():
+		record = md3conv.Surface(unpack=surface)
+		for array in (record.shaders, record.triangles, record.texcoords, record.vertices):
+			for sub in array:
+				pass
+
+	def surfaceArray():
+		for i in xrange(20):
+			md3conv.Surface(unpack=(surfaces, i * len(surface)))
+
+	def surfaceLength():
+		record = md3conv.Surface(unpack=surface)
+		def run():
+			for i in xrange(1000):
+				len(record)
+		return run
+
+	def surfacePack():
+		record = md3conv.Surface(unpack=surface)
+		return lambda: record.pack()
+
+	def pack(cls, data, count):
+		records = list(cls.unpackLazy(data, count))
+		return lambda: cls.packArray(records)
+
+	yield 'Vertex', 'single', single(bspconv.Vertex, vertices, 20000), 20000, len(vertices)
+	yield 'Vertex', 'lazy', lazy(bspconv.Vertex, vertices), 20000, len(vertices)
+	yield 'Vertex', 'file', fromFile(bspconv.Vertex, vertexFile, 20000), 20000, len(vertices)
+	yield 'Vertex', 'pack', pack(bspconv.Vertex, vertices, 20000), 20000, len(vertices)
+	yield 'Face', 'single', single(bspconv.Face, faces, 10000), 10000, len(faces)
+	yield 'Face', 'lazy', lazy(bspconv.Face, faces), 10000, len(faces)
+	yield 'Face', 'pack', pack(bspconv.Face, faces, 10000), 10000, len(faces)
+	yield 'Lightmap', 'single', single(bspconv.Lightmap, lightmaps, 8), 8, len(lightmaps)
+	yield 'Lightmap', 'pack', pack(bspconv.Lightmap, lightmaps, 8), 8, len(lightmaps)
+	yield 'Surface', 'single', single(md3conv.Surface, surface, 1), 1, len(surface)
+	yield 'Surface', 'full', surfaceFull, 1, len(surface)
+	yield 'Surface', 'array', surfaceArray, 20, len(surfaces)
+	yield 'Surface', 'len', surfaceLength(), 1000, 0
+	yield 'Surface', 'pack', surfacePack(), 1, len(surface)
+	if Struct.np is not None:
+		yield 'Vertex', 'numpy', numpyArray(bspconv.Vertex, vertices), 20000, len(vertices)
+		yield 'Face', 'numpy', numpyArray(bspconv.Face, faces), 10000, len(faces)
+		yield 'Lightmap', 'numpy', numpyArray(bspconv.Lightmap, lightmaps), 8, len(lightmaps)
+
+def run(minTime=0.2):
+	random.seed(0)
+	tmpdir = tempfile.mkdtemp()
+	results = []
+	try:
+		benchmarks = list(cases(tmpdir))
+		for mode in ('codec', 'interpreted'):
+			setCodecs(mode == 'codec')
+			for name, kind, func, records, size in benchmarks:
+				func()
+				best, runs = measure(func, minTime)
+				results.append(dict(
+					Struct=name,
+					Benchmark=kind,
+					Decoder=mode,
+					Records=records,
+					Bytes=size,
+					Seconds=best,
+					Runs=runs,
+					RecordsPerSecond=records / best,
+					BytesPerSecond=size / best
+				))
+	finally:
+		setCodecs(True)
+		for fn in os.listdir(tmpdir):
+			os.unlink(os.path.join(tmpdir, fn))
+		os.rmdir(tmpdir)
+
+	return dict(
+		Python=platform.python_version(),
+		Numpy=Struct.np.__version__ if Struct.np is not None else None,
+		Results=results
+	)
+
+def main(ofn=None, minTime='0.2'):
+	results = run(float(minTime))
+	if ofn is None:
+		json.dump(results, sys.stdout, indent=1, sort_keys=True)
+		print
+	else:
+		json.dump(results, file(ofn, 'w'), indent=1, sort_keys=True)
+
+if __name__=='__main__':
+	main(*sys.argv[1:])
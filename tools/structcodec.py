@@ -0,0 +1,206 @@
+import array, hashlib, imp, marshal, os, struct, tempfile, types
+from Struct import ABSOLUTE, ARRAY, PRIMITIVE, RELATIVE, STRING, STRUCT, STRUCT_RELATIVE, StructArray, StructException, StructList, itemsize, struct_seek
+
+# Generates straight-line Python decoders from compiled @Struct layouts, the
+# Python counterpart to Common/structgen.py.  Compiled decoders are cached on
+# disk, keyed by their source, so later runs skip straight to loading them.
+
+cachedir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__structcache__')
+
+class Codegen(object):
+	def __init__(self, layout):
+		self.layout = layout
+		self.consts = {}
+		self.names = {}
+		self.body = []
+		self.saved = {}
+		self.temps = 0
+
+	def const(self, value, prefix='c'):
+		key = id(value)
+		if key not in self.names:
+			name = '%s%i' % (prefix, len(self.names))
+			self.names[key] = name
+			self.consts[name] = value
+		return self.names[key]
+
+	def temp(self):
+		self.temps += 1
+		return 't%i' % self.temps
+
+	def stmt(self, stmt, indent=1):
+		self.body.append('\t' * indent + stmt)
+
+	def offset(self, value):
+		if isinstance(value, basestring):
+			return 'self.' + value
+		return repr(value)
+
+	def trigger(self, cb):
+		seek = getattr(cb, 'im_self', None)
+		if isinstance(seek, struct_seek) and cb.im_func is struct_seek.seek.im_func:
+			if seek.scoped:
+				name = self.temp()
+				self.saved.setdefault(id(seek), []).append(name)
+				self.stmt('%s = pos' % name)
+			offset = self.offset(seek.offset)
+			if seek.whence == ABSOLUTE:
+				self.stmt('pos = %s' % offset)
+			elif seek.whence == STRUCT_RELATIVE:
+				self.stmt('pos = start + %s' % offset)
+			elif seek.whence == RELATIVE:
+				self.stmt('pos += %s' % offset)
+			else:
+				raise StructException('Unknown seek mode %r' % seek.whence)
+		elif isinstance(seek, struct_seek) and cb.im_func is struct_seek.unseek.im_func:
+			self.stmt('pos = %s' % self.saved[id(seek)].pop())
+		else:
+			self.stmt('self.__pos__ = pos')
+			self.stmt('%s(self)' % self.const(cb, 'cb'))
+			self.stmt('pos = self.__pos__')
+
+	def store(self, name, islist, value):
+		if islist:
+			self.stmt('self.%s.append(%s)' % (name, value))
+		else:
+			self.stmt('self.%s = %s' % (name, value))
+
+	def generate(self):
+		layout = self.layout
+		self.stmt('start = self.__startpos__ = pos')
+		for name in sorted(layout.listnames):
+			self.stmt('self.%s = []' % name)
+		for cb in layout.start_triggers:
+			self.trigger(cb)
+
+		for kind, arg, name, islist, size, triggers in layout.ops:
+			if kind == PRIMITIVE:
+				unpacker = self.const(arg)
+				if all(b is None for fname, a, b in name):
+					targets = ', '.join('self.' + fname for fname, a, b in name)
+					self.stmt('%s%s = %s.unpack_from(data, pos)' % (targets, ',' if len(name) == 1 else '', unpacker))
+				else:
+					self.stmt('v = %s.unpack_from(data, pos)' % unpacker)
+					for fname, a, b in name:
+						if b is None:
+							self.stmt('self.%s = v[%i]' % (fname, a))
+						else:
+							self.stmt('self.%s = list(v[%i:%i])' % (fname, a, b))
+				self.stmt('pos += %i' % size)
+			elif kind == STRING:
+				size, offset, encoding, nullTerm, stripNulls = arg
+				if isinstance(size, str):
+					self.stmt('size = self.%s + %i' % (size, offset))
+				else:
+					self.stmt('size = %i' % size)
+				self.stmt('if len(data) - pos < size:')
+				self.stmt('raise StructException(\'Expected %i byte string, got %i\' % (size, max(len(data) - pos, 0)))', 2)
+				self.stmt('v = unpack_from(\'%is\' % size, data, pos)[0]')
+				if encoding is not None:
+					self.stmt('v = v.decode(%r)' % encoding)
+				if nullTerm:
+					self.stmt('v = v.split(\'\\0\', 1)[0]')
+				elif stripNulls:
+					self.stmt('v = v.rstrip(\'\\0\')')
+				self.store(name, islist, 'v')
+				self.stmt('pos += size')
+			elif kind == STRUCT:
+				self.stmt('v = %s(unpack=(data, pos))' % self.const(arg, 'cls'))
+				self.store(name, islist, 'v')
+				self.stmt('pos += len(v)')
+			else:
+				stype = tuple(arg.type)
+				if hasattr(arg, 'cb'):
+					self.stmt('count = %s(self)' % self.const(arg.cb, 'cb'))
+				elif hasattr(arg, 'size'):
+					self.stmt('count = %i' % arg.size)
+				elif arg.obj is None:
+					self.stmt('count = self.%s' % arg.attr)
+				else:
+					self.stmt('count = %s.%s' % (self.const(arg.obj, 'obj'), arg.attr))
+
+				# Out of line arrays are read from their own cursor, leaving pos alone.
+				if arg.offset is not None:
+					offset = self.offset(arg.offset)
+					if arg.whence == ABSOLUTE:
+						self.stmt('apos = %s' % offset)
+					elif arg.whence == STRUCT_RELATIVE:
+						self.stmt('apos = start + %s' % offset)
+					elif arg.whence == RELATIVE:
+						self.stmt('apos = pos + %s' % offset)
+					else:
+						raise StructException('Unknown seek mode %r' % arg.whence)
+					self.array(name, stype, arg, 'apos')
+				else:
+					self.array(name, stype, arg, 'pos')
+
+			for cb in triggers:
+				self.trigger(cb)
+
+		if layout.extent is not None:
+			self.stmt('pos = start + %s' % self.offset(layout.extent))
+		self.stmt('self.__pos__ = pos')
+		self.stmt('return pos')
+		return 'def unpack(self, data, pos):\n' + '\n'.join(self.body) + '\n'
+
+	def array(self, name, stype, arg, pos):
+		cls = self.const(stype[1], 'cls') if stype[0] == 'struct' else None
+		if stype[0] == 'struct' and itemsize(stype) is not None:
+			size = itemsize(stype)
+			self.stmt('if len(data) - %s < count * %i:' % (pos, size))
+			self.stmt('raise StructException(\'Expected %%i bytes for %s, got %%i\' %% (count * %i, max(len(data) - %s, 0)))' % (name, size, pos), 2)
+			self.stmt('self.%s = StructArray(%s, data, %s, count)' % (name, cls, pos))
+			self.stmt('%s += count * %i' % (pos, size))
+		elif stype[0] == 'struct' and arg.offset is not None:
+			self.stmt('self.%s = StructList(%s, data, %s, count)' % (name, cls, pos))
+		elif stype[0] == 'struct':
+			self.stmt('self.%s = arr = []' % name)
+			self.stmt('for i in xrange(count):')
+			self.stmt('v = %s(unpack=(data, %s))' % (cls, pos), 2)
+			self.stmt('arr.append(v)', 2)
+			self.stmt('%s += len(v)' % pos, 2)
+		elif arg.array:
+			self.stmt('v = array(%r, unpack_from(\'%%is\' %% (count * %i), data, %s)[0])' % (arg.typecode, stype[1], pos))
+			if arg.swap:
+				self.stmt('v.byteswap()')
+			self.stmt('self.%s = v' % name)
+			self.stmt('%s += count * %i' % (pos, stype[1]))
+		else:
+			self.stmt('self.%s = list(unpack_from(\'%s%%i%s\' %% count, data, %s))' % (name, self.layout.endian, stype[0], pos))
+			self.stmt('%s += count * %i' % (pos, stype[1]))
+
+def load(source, filename):
+	key = hashlib.sha1(imp.get_magic() + source).hexdigest()
+	path = os.path.join(cachedir, '%s.%s.pyc' % (filename, key))
+	try:
+		with file(path, 'rb') as fp:
+			code = marshal.load(fp)
+		if isinstance(code, types.CodeType):
+			return code
+	except (IOError, EOFError, ValueError, TypeError):
+		pass
+
+	# Each writer gets its own temporary file, so concurrent conversions never
+	# write into each other's; the rename then replaces the entry atomically.
+	code = compile(source, '<struct %s>' % filename, 'exec')
+	try:
+		if not os.path.isdir(cachedir):
+			os.makedirs(cachedir)
+		fd, tmppath = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+		try:
+			with os.fdopen(fd, 'wb') as fp:
+				marshal.dump(code, fp)
+			os.rename(tmppath, path)
+		except:
+			os.remove(tmppath)
+			raise
+	except (IOError, OSError):
+		pass
+	return code
+
+def build(layout):
+	gen = Codegen(layout)
+	source = gen.generate()
+	namespace = dict(gen.consts, array=array.array, StructArray=StructArray, StructList=StructList, StructException=StructException, unpack_from=struct.unpack_from)
+	exec load(source, '%s.%s' % (layout.cls.__module__, layout.cls.__name__)) in namespace
+	return namespace['unpack']